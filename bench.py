@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from hwy import Network
+import exits
+import metrics
+import render
+import synth
+
+# Benchmarks every stage, from parsing to saving, on synthetic networks
+# (see synth.py) of a few sizes
+# Stage timings come from the metrics module, so they line up with what
+# --metrics reports. Each size is run --repeat times and the fastest run of
+# each stage is kept. With --out, results are saved as JSON, and --compare
+# shows how they've changed since an earlier run (on another commit, say).
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_once(osm_file, aux_file, svg_backend):
+    del metrics.stages[:]
+
+    net = Network(osm_file)
+    with metrics.stage('aux parse'):
+        net.parse_aux_ways(aux_file)
+
+    # Everything gets rendered to memory, so disk speed doesn't come into it
+    buf = io.StringIO()
+    outputs = [('text', buf), ('svg', buf), ('json', buf)]
+    for name in sorted(name for name in net.hwys.hwys if name):
+        exits.write_outputs(net, name, outputs, svg_backend)
+
+    # Stages that run once per highway are added up
+    totals = {}
+    for s in metrics.stages:
+        if s['depth'] == 0:
+            t = totals.setdefault(s['name'], {'wall': 0, 'cpu': 0})
+            t['wall'] += s['wall']
+            t['cpu'] += s['cpu']
+
+    return totals
+
+def bench(segments, highways, repeat, svg_backend, seed):
+    with tempfile.TemporaryDirectory() as tmp:
+        osm_file = os.path.join(tmp, 'motorway.osm')
+        aux_file = os.path.join(tmp, 'link_nodes_1.osm')
+        synth.Generator(segments, highways, seed=seed).generate().save(osm_file, aux_file)
+
+        best = {}
+        for i in range(repeat):
+            for (name, t) in run_once(osm_file, aux_file, svg_backend).items():
+                if name not in best or t['wall'] < best[name]['wall']:
+                    best[name] = t
+
+    best['total'] = {
+        'wall': sum(t['wall'] for t in best.values()),
+        'cpu': sum(t['cpu'] for t in best.values()),
+    }
+    return best
+
+def print_results(results, previous = None):
+    for (size, stages) in results.items():
+        print("{} segments:".format(size))
+        for (name, t) in stages.items():
+            line = "  {:<16} {:9.4f}s wall {:9.4f}s cpu".format(name, t['wall'], t['cpu'])
+            try:
+                line += "  {:+7.1%}".format(t['wall']/previous[size][name]['wall'] - 1)
+            except (KeyError, TypeError, ZeroDivisionError):
+                pass
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark each stage of diagram generation on synthetic networks")
+    parser.add_argument('--sizes', default='100,1000,5000', help="Comma-separated list of segments per highway to run")
+    parser.add_argument('--highways', type=int, default=1, help="Highways in each network")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per size, the fastest time for each stage is kept")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--svg-backend', default='fast', choices=sorted(render.Diagram.backends))
+    parser.add_argument('--out', help="Save results to this JSON file")
+    parser.add_argument('--compare', help="Results from an earlier run to compare against")
+    args = parser.parse_args()
+
+    metrics.enable()
+    results = {}
+    for size in [int(s) for s in args.sizes.split(',')]:
+        print("Running {} segments...".format(size), file=sys.stderr)
+        results[str(size)] = bench(size, args.highways, args.repeat, args.svg_backend, args.seed)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+    print_results(results, previous)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'python': sys.version.split()[0],
+                'args': vars(args),
+                'results': results,
+            }, f, indent=2)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import gc
+import hashlib
+import logging
+import metrics
+import os
+import pickle
+
+# On-disk cache of fully built (parsed, linked, aux-matched) Networks
+# Entries are keyed on the input files and build options, plus our own
+# source, since the pickles are only good for the code that made them
+
+code_files = ['hwy.py', 'pbf.py', 'cache.py']
+# How much of the start and end of each input to hash
+sample_size = 1 << 20
+
+log = logging.getLogger('cache')
+
+def file_fingerprint(path, h):
+    st = os.stat(path)
+    h.update('{}\0{}\0{}\0'.format(os.path.abspath(path), st.st_size, st.st_mtime_ns).encode())
+
+    # Size and mtime catch nearly everything, but hash a bit of the
+    # contents too so a copied-over file with the same size still misses
+    with open(path, 'rb') as f:
+        h.update(f.read(sample_size))
+        if st.st_size > sample_size*2:
+            f.seek(-sample_size, os.SEEK_END)
+        h.update(f.read(sample_size))
+
+def fingerprint(paths, options):
+    h = hashlib.sha1()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for code_file in code_files:
+        with open(os.path.join(here, code_file), 'rb') as f:
+            h.update(f.read())
+
+    for path in sorted(paths):
+        file_fingerprint(path, h)
+    h.update(repr(sorted(options.items())).encode())
+
+    return h.hexdigest()
+
+def cache_path(cache_dir, paths, options):
+    return os.path.join(cache_dir, 'network-{}.pickle'.format(fingerprint(paths, options)))
+
+# Unpickling creates a few objects per node and segment, which sets off
+# the cyclic GC over and over for no gain (nothing's garbage yet), so it's
+# held off until we're done. That's most of the load time otherwise.
+def load(path):
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+def save(path, net):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(net, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+# Load the network for these inputs from cache_dir,
+# or build it with build() and cache it for next time
+def load_or_build(cache_dir, paths, options, build):
+    path = cache_path(cache_dir, paths, options)
+    if os.path.exists(path):
+        log.info("Loading cached network from %s...", path)
+        try:
+            with metrics.stage('cache load'):
+                return load(path)
+        except Exception as e:
+            log.warning("Couldn't load cached network (%s), rebuilding...", e)
+
+    net = build()
+    log.info("Caching network to %s...", path)
+    with metrics.stage('cache save'):
+        save(path, net)
+    return net
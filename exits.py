@@ -1,124 +1,231 @@
 #!/usr/bin/env python3
-import xml.etree.ElementTree as ET
 from hwy import Network
+import layout
 import render
+import cache
+import metrics
+import server
 from glob import glob
+from multiprocessing import Pool
+import atexit
+import contextlib
+import io
+import logging
+import os
+import re
 import sys
 import argparse
 
-parser = argparse.ArgumentParser(description = "Build a visualization of highways from OSM data")
-parser.add_argument('--svg', help="SVG file to output to")
-parser.add_argument('--dump-nodes', action='store_true', help="Dump entrance/exit nodes for links")
-parser.add_argument('--dump-type', default='all', help="Which type of nodes to dump", choices=['exit','entrance','all'])
-parser.add_argument('--osm-file', default='motorway.osm', help="OSM file to ingest")
-parser.add_argument('--aux-prefix', default='link_nodes', help="Prefix to use for aux node files")
-parser.add_argument('--highway', default='I 5', help="OSM ref of highway to render")
-args = parser.parse_args()
-
-tree = ET.parse(args.osm_file)
-net = Network(tree.getroot())
-
-if(args.dump_nodes):
-    for n in net.dump_link_nodes(args.dump_type):
-        print(n)
-    sys.exit(0)
-
-print("Getting entrance ways...", file=sys.stderr)
-for efile in glob(args.aux_prefix + "_*.osm"):
-    print("Parsing {}...".format(efile), file=sys.stderr)
-    tree = ET.parse(efile)
-    net.parse_aux_ways(tree.getroot())
-
-dwg = render.Diagram(20)
-hwy_name = args.highway
-hwy = net.hwys.get_hwy(hwy_name)
-for start in hwy.starts:
-    curhwy = dwg.add_hwy()
-
-    curseg = start
-    lastlanes = start.lanes
-    lastlinks = len(start.links)
-    link_add = 0
-    link_sub = 0
-    extra_lanes = 0
-    base_pos = 0
-    while curseg:
-        extra_lanes += curseg.add_lanes
-        curlanes = curseg.lanes + extra_lanes
-        print("Lanes/links:", lastlanes, curlanes, len(curseg.links), file=sys.stderr)
-        if(lastlanes != curlanes or len(curseg.links)):
-            lane_diff = (curlanes - lastlanes)
-
-            if(len(curseg.links)):
-                for (idx, linkdata) in enumerate(curseg.links):
-                    (type, link) = linkdata
-                    side = curseg.get_side(link)
-
-                    # Exits apply to this row
-                    if(type == 'exit'):
-                        link_sub = 1
-                    else:
-                        link_sub = 0
-
-                    print(link.describe_link(curseg), file=sys.stderr)
-                    print("Diff:", lane_diff, -link_sub, link_add, file=sys.stderr)
-                    # Add an extra row if we have lane changes
-                    # that aren't accounted for by exits/entrances
-                    if(idx == 0):
-                        if(lane_diff < 0 and -lane_diff > link_sub):
-                            print("Adding buffer row...", file=sys.stderr)
-                            row = curhwy.add_row()
-                            for n in range(curlanes):
-                                row.add_lane(render.Lane())
-                        elif(lane_diff > 0 and lane_diff > link_add):
-                            print("Adding buffer row...", file=sys.stderr)
-                            row = curhwy.add_row()
-                            for n in range(lastlanes):
-                                row.add_lane(render.Lane())
-
-
-                    row = curhwy.add_row()
-                    for n in range(curlanes):
-                        row.add_lane(render.Lane())
-
-                    if(type == 'exit'):
-                        row.add_link(render.Exit(side, link.get_number()))
-                    else:
-                        row.add_link(render.Entrance(side, link.get_number()))
-                    row.add_link(render.Label(side, type, link.describe_link(curseg)))
-
-                    # Entrances apply to next row
-                    if(type == 'entrance'):
-                        link_add = 1
-                    else:
-                        link_add = 0
-
-                    # Update lastlanes for entrance rendering
-                    lastlanes = curlanes
-            else:
-                if(lane_diff < 0 and -lane_diff > link_sub):
-                    print("Adding buffer row...", file=sys.stderr)
-                    row = curhwy.add_row()
-                    for n in range(curlanes):
-                        row.add_lane(render.Lane())
-                elif(lane_diff > 0 and lane_diff > link_add):
-                    print("Adding buffer row...", file=sys.stderr)
-                    row = curhwy.add_row()
-                    for n in range(lastlanes):
-                        row.add_lane(render.Lane())
-
-                row = curhwy.add_row()
-                for n in range(curlanes):
-                    row.add_lane(render.Lane())
-
-        lastlanes = curlanes
-        lastlinks = len(curseg.links)
-        extra_lanes -= curseg.remove_lanes
-        curseg = hwy.next(curseg)
-
-dwg.render('text')
-if(args.svg):
-    print("Rendering SVG...", file=sys.stderr)
-    dwg.render()
-    print("Writing...", file=sys.stderr)
-    dwg.save(args.svg)
+log = logging.getLogger('exits')
+
+def build_network(args, aux_files):
+    net = Network(args.osm_file, compact_nodes=args.compact_nodes, jobs=args.jobs, compact_index=args.compact_index)
+
+    # Link nodes don't depend on aux ways, don't bother with them
+    if(args.dump_nodes):
+        return net
+
+    log.info("Getting entrance ways...")
+    with metrics.stage('aux parse') as stage:
+        if(args.aux_source):
+            log.info("Extracting from %s...", args.aux_source)
+            net.extract_aux_ways(args.aux_source, args.dump_type, jobs=args.jobs)
+        else:
+            for efile in aux_files:
+                log.info("Parsing %s...", efile)
+                net.parse_aux_ways(efile)
+        stage.count(aux_links=sum(len(l.aux_links) for l in net.link_segs.segs.values()))
+
+    return net
+
+def build_diagram(layouts, svg_backend = 'svgwrite'):
+    dwg = render.Diagram(20, svg_backend)
+    for hwy_layout in layouts:
+        dwg.add_layout(hwy_layout)
+
+    return dwg
+
+output_formats = ['text', 'svg', 'json']
+
+# Write out each (format, target) in outputs, where target is a filename
+# or a file object
+# Layout is done once for all of them, and the diagram is only drawn if
+# something needs it
+# jobs is how many processes to render SVG rows with
+def write_outputs(net, hwy_name, outputs, svg_backend = 'svgwrite', jobs = 1):
+    with metrics.stage('layout') as stage:
+        layouts = layout.layout_hwy(net.hwys.get_hwy(hwy_name))
+        stage.count(routes=len(layouts), rows=sum(len(l) for l in layouts))
+
+    dwg = None
+    for (fmt, target) in outputs:
+        if(fmt != 'json' and dwg is None):
+            with metrics.stage('render'):
+                dwg = build_diagram(layouts, svg_backend)
+
+        with metrics.stage('save ' + fmt) as stage:
+            write_output(layouts, dwg, fmt, target, jobs)
+            if isinstance(target, str):
+                stage.count(bytes=os.path.getsize(target))
+
+def write_output(layouts, dwg, fmt, target, jobs):
+    if(fmt == 'svg' and isinstance(target, str)):
+        # Handles .svgz
+        dwg.save(target, jobs)
+        return
+
+    with (open(target, 'w', encoding='utf-8') if isinstance(target, str) else contextlib.nullcontext(target)) as f:
+        if(fmt == 'json'):
+            layout.dump(layouts, f)
+        elif(fmt == 'text'):
+            dwg.render(f)
+        else:
+            dwg.stream(f, jobs)
+
+def render_string(net, hwy_name, fmt = 'svg', svg_backend = 'svgwrite'):
+    buf = io.StringIO()
+    write_outputs(net, hwy_name, [(fmt, buf)], svg_backend)
+    return buf.getvalue()
+
+def safe_filename(name):
+    return re.sub(r'[^\w.-]+', '_', name)
+
+# Set up in each batch worker by the pool initializer
+# With fork, the network is shared with the parent rather than copied over
+worker_net = None
+worker_out_dir = None
+worker_svg_backend = None
+worker_exts = None
+
+def init_worker(net, out_dir, svg_backend, exts):
+    global worker_net, worker_out_dir, worker_svg_backend, worker_exts
+    worker_net = net
+    worker_out_dir = out_dir
+    worker_svg_backend = svg_backend
+    worker_exts = exts
+
+# Returns the highway's name, and the stages it recorded for the parent's
+# metrics report
+# Failures here are bugs, so they take the batch down (with the worker's
+# traceback) rather than leaving a highway quietly missing from it
+def render_batch(hwy_name):
+    base = os.path.join(worker_out_dir, safe_filename(hwy_name))
+    outputs = [(fmt, base + ext) for (fmt, ext) in worker_exts.items()]
+    first_stage = len(metrics.stages)
+    try:
+        write_outputs(worker_net, hwy_name, outputs, worker_svg_backend)
+    except Exception:
+        # Don't leave half-written files behind
+        for (_, filename) in outputs:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(filename)
+        raise
+
+    records = metrics.take(first_stage)
+    for record in records:
+        record['highway'] = hwy_name
+    return (hwy_name, records)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Build a visualization of highways from OSM data")
+    parser.add_argument('--svg', help="SVG file to output to (gzipped if it ends in .svgz, - for stdout)")
+    parser.add_argument('--text', help="File to write the text diagram to (- for stdout, the default if no other output is given)")
+    parser.add_argument('--json', help="File to write the diagram's layout to as JSON (- for stdout)")
+    parser.add_argument('--dump-nodes', action='store_true', help="Dump entrance/exit nodes for links")
+    parser.add_argument('--dump-type', default='all', help="Which type of nodes to dump", choices=['exit','entrance','all'])
+    parser.add_argument('--osm-file', default='motorway.osm', help="OSM file to ingest (.osm or .osm.pbf)")
+    parser.add_argument('--aux-prefix', default='link_nodes', help="Prefix to use for aux node files")
+    parser.add_argument('--aux-source', help="Full OSM extract (.osm or .osm.pbf) to pull aux ways from directly, instead of aux node files")
+    parser.add_argument('--highway', action='append', help="OSM ref of highway to render (default: I 5), can be given multiple times with --out-dir")
+    parser.add_argument('--all-highways', action='store_true', help="Render every highway in the network (requires --out-dir)")
+    parser.add_argument('--out-dir', help="Batch mode: write <ref>.svg and <ref>.txt for each highway into this directory")
+    parser.add_argument('--format', action='append', choices=output_formats, help="Batch mode: which files to write for each highway (default: text and svg), can be given multiple times")
+    parser.add_argument('--svgz', action='store_true', help="Batch mode: write gzipped <ref>.svgz files instead of .svg")
+    parser.add_argument('--jobs', type=int, help="Number of processes to use for decoding PBF files and batch rendering (default: all cores), and for rendering a single SVG (default: 1)")
+    parser.add_argument('--compact-nodes', action='store_true', help="Store nodes in compact arrays (requires numpy)")
+    parser.add_argument('--compact-index', action='store_true', help="Store segment indexes in compact arrays (requires numpy)")
+    parser.add_argument('--cache-dir', help="Cache built networks in this directory, and reuse them while the inputs are unchanged")
+    parser.add_argument('--serve', type=int, metavar='PORT', help="Serve diagrams over HTTP at /svg/<ref> and /text/<ref> instead of rendering once")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to serve on")
+    parser.add_argument('--render-cache-mb', type=int, default=64, help="Size of the server's rendered diagram cache")
+    parser.add_argument('--metrics', help="Write timings (and memory use, with --profile) for each stage of the run to this JSON file")
+    parser.add_argument('--profile', metavar='DIR', help="Trace memory use and dump a cProfile of each stage into DIR (plus metrics.json, unless --metrics is given)")
+    parser.add_argument('-v', '--verbose', action='count', default=0, help="Show progress (-v), or all debug output (-vv)")
+    parser.add_argument('--debug', action='append', default=[], metavar='SUBSYSTEM', help="Show debug output for one part of the run: hwy, hwy.aux, layout, cache, server or exits (can be given multiple times)")
+    parser.add_argument('--svg-backend', default='svgwrite', choices=sorted(render.Diagram.backends), help="How to generate SVGs: 'fast' writes the same output without svgwrite's validation")
+    args = parser.parse_args()
+
+    # Quiet unless asked otherwise
+    levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(format='%(name)s: %(message)s', level=levels[min(args.verbose, len(levels)-1)])
+    for name in args.debug:
+        logging.getLogger(name).setLevel(logging.DEBUG)
+    if(args.serve and not args.verbose):
+        logging.getLogger('server').setLevel(logging.INFO)
+
+    if(args.profile):
+        metrics.enable_profiling(args.profile)
+    if(args.metrics or args.profile):
+        metrics.enable()
+        atexit.register(metrics.write_report, args.metrics or os.path.join(args.profile, 'metrics.json'))
+
+    if(args.aux_source):
+        aux_files = [args.aux_source]
+    else:
+        aux_files = sorted(glob(args.aux_prefix + "_*.osm"))
+
+    def load_network():
+        if(args.cache_dir):
+            return cache.load_or_build(args.cache_dir, [args.osm_file] + aux_files, {
+                'compact_nodes': args.compact_nodes,
+                'compact_index': args.compact_index,
+                'with_aux': not args.dump_nodes,
+                'aux_source': bool(args.aux_source),
+                'dump_type': args.dump_type,
+            }, lambda: build_network(args, aux_files))
+        else:
+            return build_network(args, aux_files)
+
+    if(args.serve):
+        server.serve(args.host, args.serve, load_network,
+            lambda net, ref, fmt: render_string(net, ref, fmt, args.svg_backend),
+            [args.osm_file] + aux_files, args.render_cache_mb*1024*1024)
+        sys.exit(0)
+
+    net = load_network()
+
+    if(args.dump_nodes):
+        for n in net.dump_link_nodes(args.dump_type):
+            print(n)
+        sys.exit(0)
+
+    hwy_names = args.highway or ['I 5']
+    unknown = [name for name in hwy_names if name not in net.hwys.hwys]
+    if unknown:
+        parser.error("No such highway: {}".format(', '.join(unknown)))
+    if(args.out_dir):
+        if(args.all_highways):
+            hwy_names = sorted(name for name in net.hwys.hwys if name)
+
+        exts = {'text': '.txt', 'svg': '.svgz' if args.svgz else '.svg', 'json': '.json'}
+        exts = {fmt: exts[fmt] for fmt in (args.format or ['text', 'svg'])}
+        os.makedirs(args.out_dir, exist_ok=True)
+        with metrics.stage('batch render') as stage, Pool(args.jobs, init_worker, (net, args.out_dir, args.svg_backend, exts)) as pool:
+            for (name, records) in pool.imap_unordered(render_batch, hwy_names):
+                log.info("Rendered %s", name)
+                metrics.merge(records)
+                stage.count(highways=1)
+        sys.exit(0)
+    elif(args.all_highways or len(hwy_names) > 1):
+        parser.error("Rendering multiple highways requires --out-dir")
+
+    outputs = [(fmt, getattr(args, fmt)) for fmt in output_formats if getattr(args, fmt)]
+    if not outputs:
+        outputs = [('text', '-')]
+    outputs = [(fmt, sys.stdout if target == '-' else target) for (fmt, target) in outputs]
+    # Forking only pays off on big diagrams with cores to spare, so
+    # single diagrams stay in one process unless asked
+    write_outputs(net, hwy_names[0], outputs, args.svg_backend, args.jobs or 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+from xml.sax.saxutils import escape
+
+# Lightweight stand-in for the parts of svgwrite we use
+# Same element factory/transform API and the same output, but
+# attributes aren't validated and documents are serialized directly
+# to strings rather than built up as XML trees and pretty-printed
+
+def flatten(values):
+    for v in values:
+        if isinstance(v, (list, tuple)):
+            yield from flatten(v)
+        else:
+            yield v
+
+def strlist(values, separator=','):
+    if isinstance(values, str):
+        return values
+    return separator.join(str(v) for v in flatten(values) if v is not None)
+
+def quote(value):
+    return escape(str(value), {'"': '&quot;'})
+
+class Element:
+    elementname = None
+
+    def __init__(self, **extra):
+        self.attribs = {}
+        self.elements = []
+        for (key, value) in extra.items():
+            self[key] = value
+
+    # svgwrite style keyword names: stroke_width => stroke-width
+    def __setitem__(self, key, value):
+        self.attribs[key.rstrip('_').replace('_', '-')] = value
+
+    def __getitem__(self, key):
+        return self.attribs[key]
+
+    def add(self, element):
+        self.elements.append(element)
+        return element
+
+    def _add_transformation(self, new_transform):
+        old_transform = self.attribs.get('transform', '')
+        self.attribs['transform'] = ('{} {}'.format(old_transform, new_transform)).strip()
+
+    def translate(self, tx, ty = None):
+        self._add_transformation('translate({})'.format(strlist([tx, ty])))
+
+    def scale(self, sx, sy = None):
+        self._add_transformation('scale({})'.format(strlist([sx, sy])))
+
+    def fill(self, color = None, rule = None, opacity = None):
+        if color is not None:
+            self['fill'] = color
+        if rule is not None:
+            self['fill-rule'] = rule
+        if opacity is not None:
+            self['fill-opacity'] = opacity
+
+    def stroke(self, color = None, width = None, opacity = None, linecap = None, linejoin = None, miterlimit = None):
+        if color is not None:
+            self['stroke'] = color
+        if width is not None:
+            self['stroke-width'] = width
+        if opacity is not None:
+            self['stroke-opacity'] = opacity
+        if linecap is not None:
+            self['stroke-linecap'] = linecap
+        if linejoin is not None:
+            self['stroke-linejoin'] = linejoin
+        if miterlimit is not None:
+            self['stroke-miterlimit'] = miterlimit
+
+    def dasharray(self, dasharray = None, offset = None):
+        if dasharray is not None:
+            self['stroke-dasharray'] = strlist(dasharray, ' ')
+        if offset is not None:
+            self['stroke-dashoffset'] = offset
+
+    def get_attribs(self):
+        return self.attribs
+
+    def open_tag(self):
+        attrs = ''.join(
+            ' {}="{}"'.format(k, quote(v))
+            for (k, v) in sorted(self.get_attribs().items())
+        )
+        return '<' + self.elementname + attrs
+
+    # Append serialized lines to out, indented the same way svgwrite's
+    # pretty printing does
+    def serialize(self, out, pretty = True, level = 0):
+        pad = '  '*level if pretty else ''
+        end = '\n' if pretty else ''
+        text = self.get_text()
+        if text is not None:
+            out.append(pad + self.open_tag() + '>' + escape(text) + '</' + self.elementname + '>' + end)
+        elif not self.elements:
+            out.append(pad + self.open_tag() + '/>' + end)
+        else:
+            out.append(pad + self.open_tag() + '>' + end)
+            for el in self.elements:
+                el.serialize(out, pretty, level + 1)
+            out.append(pad + '</' + self.elementname + '>' + end)
+
+    def get_text(self):
+        return None
+
+class Group(Element):
+    elementname = 'g'
+
+class Defs(Element):
+    elementname = 'defs'
+
+class Symbol(Element):
+    elementname = 'symbol'
+
+class Use(Element):
+    elementname = 'use'
+
+    def __init__(self, href, insert = None, **extra):
+        super().__init__(**extra)
+        self.attribs['xlink:href'] = href
+        if insert is not None:
+            (self['x'], self['y']) = insert
+
+class Text(Element):
+    elementname = 'text'
+
+    def __init__(self, text, insert = None, **extra):
+        super().__init__(**extra)
+        self.text = text
+        if insert is not None:
+            (self['x'], self['y']) = insert
+
+    def get_text(self):
+        return self.text
+
+class Path(Element):
+    elementname = 'path'
+
+    def __init__(self, d = None, **extra):
+        super().__init__(**extra)
+        self.commands = []
+        if d is not None:
+            self.push(d)
+
+    def push(self, *elements):
+        self.commands.extend(elements)
+
+    def get_attribs(self):
+        attribs = dict(self.attribs)
+        attribs['d'] = strlist(self.commands, ' ')
+        return attribs
+
+class Rect(Element):
+    elementname = 'rect'
+
+    def __init__(self, insert = (0, 0), size = (1, 1), **extra):
+        super().__init__(**extra)
+        (self['x'], self['y']) = insert
+        (self['width'], self['height']) = size
+
+class Pattern(Element):
+    elementname = 'pattern'
+
+    def __init__(self, insert = None, size = None, **extra):
+        super().__init__(**extra)
+        if insert is not None:
+            (self['x'], self['y']) = insert
+        if size is not None:
+            (self['width'], self['height']) = size
+
+class Line(Element):
+    elementname = 'line'
+
+    def __init__(self, start = (0, 0), end = (0, 0), **extra):
+        super().__init__(**extra)
+        (self['x1'], self['y1']) = start
+        (self['x2'], self['y2']) = end
+
+class Drawing(Element):
+    elementname = 'svg'
+    header = '<?xml version="1.0" encoding="utf-8" ?>\n'
+    namespaces = ' xmlns="http://www.w3.org/2000/svg" xmlns:ev="http://www.w3.org/2001/xml-events" xmlns:xlink="http://www.w3.org/1999/xlink"'
+
+    def __init__(self, **extra):
+        super().__init__(**extra)
+        self.attribs.setdefault('baseProfile', 'full')
+        self.attribs.setdefault('version', '1.1')
+        self.defs = self.add(Defs())
+
+    def open_tag(self):
+        tag = super().open_tag()
+        return tag[:len(self.elementname)+1] + self.namespaces + tag[len(self.elementname)+1:]
+
+    def g(self, **extra):
+        return Group(**extra)
+
+    def symbol(self, **extra):
+        return Symbol(**extra)
+
+    def use(self, href, insert = None, **extra):
+        return Use(href, insert, **extra)
+
+    def text(self, text, insert = None, **extra):
+        return Text(text, insert, **extra)
+
+    def path(self, d = None, **extra):
+        return Path(d, **extra)
+
+    def rect(self, insert = (0, 0), size = (1, 1), **extra):
+        return Rect(insert, size, **extra)
+
+    def line(self, start = (0, 0), end = (0, 0), **extra):
+        return Line(start, end, **extra)
+
+    def pattern(self, insert = None, size = None, **extra):
+        return Pattern(insert, size, **extra)
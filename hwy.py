@@ -1,91 +1,437 @@
+import logging
 import math
+import os
 import sys
-from collections import defaultdict
+import xml.etree.ElementTree as ET
+from array import array
+from collections import defaultdict, namedtuple
+import metrics
+import pbf
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger('hwy')
+# Matching aux ways to links is chatty enough to want its own switch
+aux_log = logging.getLogger('hwy.aux')
+
+# Yield the top-level OSM elements with the given tags
+# If source is a filename (or file object), the file is parsed incrementally
+# and each element is dropped from the tree once it's been handed off,
+# so we never hold the whole document in memory
+def iter_elements(source, tags=('node', 'way')):
+    if not (isinstance(source, (str, os.PathLike)) or hasattr(source, 'read')):
+        if hasattr(source, 'getroot'):
+            source = source.getroot()
+        for el in source.iter():
+            if el.tag in tags:
+                yield el
+        return
+
+    context = ET.iterparse(source, events=('start', 'end'))
+    (_, root) = next(context)
+    depth = 0
+    for (event, el) in context:
+        if event == 'start':
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 0:
+            if el.tag in tags:
+                yield el
+            # Anything we wanted to keep has been referenced by now
+            root.clear()
 
 class OsmElm:
-    def __init__(self, el):
-        self.el = el
+    __slots__ = ('tags',)
+    # Tags we actually read - everything else is dropped at parse time
+    tag_keys = frozenset()
+
+    def __init__(self, tags):
+        self.tags = tags
+
+    @classmethod
+    def read_tags(cls, el):
+        tags = {}
+        for tagel in el.findall('tag'):
+            k = tagel.get('k')
+            if k in cls.tag_keys:
+                tags[sys.intern(k)] = tagel.get('v')
+
+        # Most elements have nothing we care about, don't keep empty dicts around
+        return tags or None
+
+    @classmethod
+    def filter_tags(cls, tags):
+        tags = {sys.intern(k): v for (k, v) in tags.items() if k in cls.tag_keys}
+        return tags or None
 
     def get_tag(self, *args):
-        for k in args:
-            tagel = self.el.find("./tag[@k='{}']".format(k))
-            # I'm not sure why this is necessary?
-            # Maybe it's not?
-            if(hasattr(tagel, 'get')):
-                return tagel.get('v')
-            elif(hasattr(tagel, 'attrib')):
-                return tagel.attrib.get('v')
+        if self.tags:
+            for k in args:
+                v = self.tags.get(k)
+                if v is not None:
+                    return v
 
         return None
 
 class Node(OsmElm):
-    def __init__(self, xmlobj):
-        super().__init__(xmlobj)
+    __slots__ = ('id', 'lat', 'lon', 'name')
+    tag_keys = frozenset(['highway', 'ref', 'exit_to', 'exit_to:left', 'exit_to:right'])
 
-        self.id = int(xmlobj.get('id'))
-        self.lat = float(xmlobj.get('lat'))
-        self.lon = float(xmlobj.get('lon'))
-        try:
-            nodetype = self.get_tag('highway')
-            if(nodetype == 'motorway_junction'):
-                self.name = self.get_tag('ref')
-            else:
-                self.name = None
-        except AttributeError:
+    def __init__(self, id, lat, lon, tags = None):
+        super().__init__(tags)
+
+        self.id = id
+        self.lat = lat
+        self.lon = lon
+        if(self.get_tag('highway') == 'motorway_junction'):
+            self.name = self.get_tag('ref')
+        else:
             self.name = None
 
+    @classmethod
+    def from_xml(cls, el):
+        return cls(
+            int(el.get('id')),
+            float(el.get('lat')),
+            float(el.get('lon')),
+            cls.read_tags(el)
+        )
+
+# Array-backed stand-in for the {id: Node} node pool
+# Coordinates are kept in OSM's 1e-7 fixed point, ids are sorted
+# and resolved by binary search, and Node objects are built on access
+# Only the (few) nodes that have tags we care about keep them
+class NodeStore:
+    scale = 10000000
+
+    def __init__(self):
+        if np is None:
+            raise RuntimeError("Compact node storage requires numpy")
+
+        self.ids = array('q')
+        self.lats = array('i')
+        self.lons = array('i')
+        self.tags = {}
+        self.frozen = False
+
+    def __setitem__(self, id, node):
+        if self.frozen:
+            raise RuntimeError("Can't add nodes to a frozen NodeStore")
+
+        self.ids.append(id)
+        self.lats.append(round(node.lat*self.scale))
+        self.lons.append(round(node.lon*self.scale))
+        if node.tags:
+            self.tags[id] = node.tags
+
+    # Pack the parsed nodes into sorted arrays
+    def freeze(self):
+        if self.frozen:
+            return
+
+        ids = np.frombuffer(self.ids, dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        self.ids = ids[order]
+        self.lats = np.frombuffer(self.lats, dtype=np.int32)[order]
+        self.lons = np.frombuffer(self.lons, dtype=np.int32)[order]
+        self.frozen = True
+
+    def find(self, id):
+        self.freeze()
+        row = int(np.searchsorted(self.ids, id))
+        if row < len(self.ids) and self.ids[row] == id:
+            return row
+
+        return None
+
+    def __getitem__(self, id):
+        row = self.find(id)
+        if row is None:
+            raise KeyError(id)
+
+        return Node(
+            int(id),
+            int(self.lats[row])/self.scale,
+            int(self.lons[row])/self.scale,
+            self.tags.get(id)
+        )
+
+    def get(self, id, default = None):
+        try:
+            return self[id]
+        except KeyError:
+            return default
+
+    def __contains__(self, id):
+        return self.find(id) is not None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        self.freeze()
+        return (int(id) for id in self.ids)
+
+    # Vectorized lookup of float coordinates for an array of node ids
+    def coords(self, ids):
+        self.freeze()
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = np.searchsorted(self.ids, ids)
+        rows[rows == len(self.ids)] = 0
+        missing = (self.ids[rows] != ids)
+        if missing.any():
+            raise KeyError(int(ids[missing][0]))
+
+        return (self.lats[rows]/self.scale, self.lons[rows]/self.scale)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return (self[id] for id in self)
+
+    def items(self):
+        return ((id, self[id]) for id in self)
+
 class Network:
-    def __init__(self, osmTree):
-        self.xml = osmTree
-        self.nodes = {}
+    seg_types = ['motorway', 'motorway_link']
+
+    # osm_source can be a parsed tree/element, or a filename to stream from
+    # .osm.pbf files are read directly, decoding blocks across jobs processes
+    # compact_nodes stores the node pool in a NodeStore instead of a dict
+    # compact_index freezes the segment indexes into arrays after parsing
+    def __init__(self, osm_source, compact_nodes = False, jobs = None, compact_index = False):
+        self.nodes = NodeStore() if compact_nodes else {}
         self.hwys = {}
         self.link_segs = SegIndex()
         self.hwy_segs = SegIndex('get_hwys')
+        self.node_segs = NodeSegIndex()
 
-        self.parse_nodes()
-        self.parse_ways()
-
-        self.link_ways()
-
-        self.hwys = HwySet(self.hwy_segs)
-
-    def parse_nodes(self):
-        print("Getting nodes...", file=sys.stderr)
-        for n in self.xml.iter('node'):
-            curnode = Node(n)
-            self.nodes[curnode.id] = curnode
+        if str(osm_source).endswith('.pbf'):
+            self.parse_pbf(osm_source, jobs)
+        else:
+            self.parse(osm_source)
+        if compact_nodes:
+            self.nodes.freeze()
+        if compact_index:
+            self.hwy_segs.freeze()
+            self.link_segs.freeze()
+
+        with metrics.stage('link ways') as stage:
+            self.link_ways()
+            stage.count(links=sum(len(s.links) for s in self.hwy_segs.segs.values()))
+
+        with metrics.stage('highway set') as stage:
+            self.hwys = HwySet(self.hwy_segs)
+            stage.count(highways=len(self.hwys.hwys))
+
+    def count_segs(self, stage):
+        stage.count(hwy_segs=len(self.hwy_segs.segs), link_segs=len(self.link_segs.segs))
+
+    # Nodes and ways are handled in a single pass over the source
+    # OSM files list all nodes before ways, so the node pool
+    # is complete by the time we get to the first way
+    def parse(self, osm_source):
+        elements = iter_elements(osm_source)
+        first_way = None
+
+        log.info("Getting nodes...")
+        with metrics.stage('node parse') as stage:
+            for el in elements:
+                if el.tag != 'node':
+                    first_way = el
+                    break
+                self.parse_node(el)
+            stage.count(nodes=len(self.nodes))
+
+        if first_way is None:
+            return
+
+        # Picks up where the nodes left off
+        log.info("Getting ways...")
+        with metrics.stage('way parse') as stage:
+            self.parse_way(first_way)
+            for el in elements:
+                self.parse_way(el)
+            self.count_segs(stage)
+
+    # PBF files list nodes before ways too, but we only want the nodes our
+    # ways use, so the ways get decoded first and nodes filtered against them
+    def parse_pbf(self, filename, jobs = None):
+        reader = pbf.Reader(filename, jobs)
+
+        log.info("Getting ways...")
+        with metrics.stage('way parse') as stage:
+            ways = reader.ways(pbf.WayFilter(self.seg_types))
+            node_ids = set(n for (_, refs, _) in ways for n in refs)
+            stage.count(ways=len(ways))
+
+        log.info("Getting nodes...")
+        with metrics.stage('node parse') as stage:
+            for (id, lat, lon, tags) in reader.nodes(node_ids):
+                self.add_node(Node(id, lat, lon, Node.filter_tags(tags)))
+            stage.count(nodes=len(self.nodes))
+
+        with metrics.stage('segment build') as stage:
+            for (id, refs, tags) in ways:
+                self.add_way(id, refs, Seg.filter_tags(tags))
+            self.count_segs(stage)
+
+    def parse_node(self, el):
+        self.add_node(Node.from_xml(el))
+
+    def parse_way(self, way):
+        self.add_way(int(way.get('id')), Seg.read_nodes(way), Seg.read_tags(way))
+
+    def add_node(self, node):
+        self.nodes[node.id] = node
+
+    def add_way(self, id, nodes, tags):
+        if not tags or tags.get('oneway') != 'yes':
+            return
+
+        seg_type = tags.get('highway')
+        if(seg_type == 'motorway'):
+            seg = HwySeg(id, nodes, tags, self)
+            self.hwy_segs.add(seg)
+        elif(seg_type == 'motorway_link'):
+            seg = LinkSeg(id, nodes, tags, self)
+            self.link_segs.add(seg)
+        else:
+            return
+        self.node_segs.add(seg)
+
+    def parse_aux_ways(self, osm_source):
+        for way in iter_elements(osm_source, ('way',)):
+            self.add_aux_way(Seg.from_xml(way, self))
+
+    # Pull the ways that our links connect to out of a full extract
+    # This does the job of --dump-nodes and entrance_nodes.sh in one pass:
+    # keep any way that touches one of our link nodes and isn't a link itself
+    def extract_aux_ways(self, osm_source, types = 'all', jobs = None):
+        node_ids = self.dump_link_nodes(types)
+
+        if str(osm_source).endswith('.pbf'):
+            reader = pbf.Reader(osm_source, jobs)
+            ways = reader.ways(pbf.WayFilter(node_refs=node_ids, drop_highways=['motorway_link']))
+            for (id, refs, tags) in ways:
+                self.add_aux_way(Seg(id, refs, Seg.filter_tags(tags), self))
+        else:
+            for way in iter_elements(osm_source, ('way',)):
+                refs = Seg.read_nodes(way)
+                if node_ids.isdisjoint(refs):
+                    continue
 
-    def parse_ways(self):
-        print("Getting ways...", file=sys.stderr)
-        for way in self.xml.iter('way'):
-            try:
-                if(way.find("./tag[@k='oneway']").get('v') != 'yes'):
+                tags = Seg.read_tags(way)
+                if tags and tags.get('highway') == 'motorway_link':
                     continue
-            except AttributeError:
-                continue
 
-            seg_type = way.find("./tag[@k='highway']").get('v')
-            if(seg_type == 'motorway'):
-                self.hwy_segs.add(HwySeg(way, self))
-            elif(seg_type == 'motorway_link'):
-                self.link_segs.add(LinkSeg(way, self))
-
-    def parse_aux_ways(self, osmTree):
-        for way in osmTree.iter('way'):
-            newseg = Seg(way, self)
-            for n_id in newseg.nodes:
-                for match_id in self.link_segs.lookup(n_id, 'start'):
-                    if(match_id and match_id != newseg.id):
-                        for end_link in self.link_segs.lookup_last(match_id, 'end'):
-                            print("Matched entrance link {} to segment {} from {} via node {}".format(newseg.id, end_link.id, match_id, n_id), file=sys.stderr)
-                            end_link.aux_links[newseg.id] = newseg
+                self.add_aux_way(Seg(int(way.get('id')), refs, tags, self))
+
+    def add_aux_way(self, newseg):
+        for n_id in newseg.nodes:
+            for match in self.link_segs.lookup_segs(n_id, 'start'):
+                if(match.id != newseg.id):
+                    for end_link in self.link_segs.lookup_last(match.id, 'end'):
+                        aux_log.debug("Matched entrance link %s to segment %s from %s via node %s", newseg.id, end_link.id, match.id, n_id)
+                        end_link.aux_links[newseg.id] = newseg
+
+    # The node index is cheaper to rebuild than to pickle, and a loaded
+    # network rarely needs it (chain ends are precomputed), so it's only
+    # rebuilt if something looks a node up
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['node_segs']
+        return state
+
+    # Segments are pickled without references back to us (or to each other),
+    # which keeps pickling shallow, so hook them back up on load
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for idx in (self.hwy_segs, self.link_segs):
+            for seg in idx.segs.values():
+                seg.attach(self)
+        self.node_segs = NodeSegIndex((self.hwy_segs, self.link_segs))
 
     def link_ways(self):
         for s in self.hwy_segs.segs.values():
-            s.post_process(self.hwy_segs, self.link_segs)
+            s.post_process(self.node_segs)
 
         for s in self.link_segs.segs.values():
-            s.post_process(self.hwy_segs, self.link_segs)
+            s.post_process(self.node_segs)
+
+        self.compute_link_geometry()
+        self.link_segs.precompute_lasts()
+        # That's everything the node index was needed for, and it's big,
+        # so it's dropped here and only rebuilt if something looks a node up
+        self.node_segs = NodeSegIndex((self.hwy_segs, self.link_segs))
+
+    def get_coords(self, node_ids):
+        if isinstance(self.nodes, NodeStore):
+            return self.nodes.coords(node_ids)
+
+        nodes = [self.nodes[n] for n in node_ids]
+        return (
+            np.array([n.lat for n in nodes], dtype=np.float64),
+            np.array([n.lon for n in nodes], dtype=np.float64),
+        )
+
+    # Work out type, relative angle and side for every (trunk, link) pair
+    # up front, so rendering just reads them back off the trunk
+    # Pairs whose geometry is degenerate are left for get_rel_ang to
+    # compute (and complain about) on demand
+    def compute_link_geometry(self):
+        pairs = []
+        for trunk in self.hwy_segs.segs.values():
+            for (t, link) in trunk.links:
+                link_type = trunk.link_geom[link.id][0]
+                if link_type is None or len(link.nodes) < 2:
+                    continue
+
+                rev = (link_type == 'entrance')
+                step = -1 if rev else 1
+                pivot = trunk.junctions[link.id]
+                if not (0 <= pivot + step < len(trunk.nodes)):
+                    continue
+                link_pivot = len(link.nodes)-1 if rev else 0
+
+                pairs.append((trunk, link, link_type, (
+                    link.nodes[link_pivot], link.nodes[link_pivot + step],
+                    trunk.nodes[pivot], trunk.nodes[pivot + step],
+                )))
+
+        if not pairs:
+            return
+
+        if np is None:
+            for (trunk, link, link_type, _) in pairs:
+                try:
+                    rel_ang = trunk.get_rel_ang(link)
+                except ValueError:
+                    continue
+                trunk.link_geom[link.id] = (link_type, rel_ang, HwySeg.side_from_ang(link_type, rel_ang))
+            return
+
+        (lat, lon) = self.get_coords([n for p in pairs for n in p[3]])
+        lat = lat.reshape(-1, 4)
+        lon = lon.reshape(-1, 4)
+        link_ang = np.arctan2(lon[:,1] - lon[:,0], lat[:,1] - lat[:,0])
+        trunk_ang = np.arctan2(lon[:,3] - lon[:,2], lat[:,3] - lat[:,2])
+        diff = link_ang - trunk_ang
+
+        valid = (np.abs(diff) != math.pi)
+        wrap = (np.abs(diff) > math.pi)
+        diff[wrap] -= np.copysign(2*math.pi, diff[wrap])
+
+        for (i, (trunk, link, link_type, _)) in enumerate(pairs):
+            if valid[i]:
+                rel_ang = float(diff[i])
+                trunk.link_geom[link.id] = (link_type, rel_ang, HwySeg.side_from_ang(link_type, rel_ang))
 
     def dump_link_nodes(self, types):
         nodes = set()
@@ -95,25 +441,31 @@ class Network:
         return nodes
 
 class Seg(OsmElm):
+    __slots__ = (
+        'network', 'node_pool', 'id', 'nodes', 'start', 'end', 'name', 'type',
+        'lanes', 'lanedata', 'node_pos',
+    )
     lane_keys = ['turn','hov','hgv','bus','motor_vehicle','motorcycle']
+    tag_keys = frozenset([
+        'ref', 'name', 'highway', 'oneway', 'lanes',
+        'destination:ref:to', 'destination:ref', 'destination',
+    ] + [key + ':lanes' for key in lane_keys])
 
-    def __init__(self, el, network):
-        super().__init__(el)
+    def __init__(self, id, nodes, tags, network):
+        super().__init__(tags)
         self.network = network
         self.node_pool = network.nodes
 
-        self.id = int(self.el.attrib.get('id'))
+        self.id = id
 
-        self.nodes = [int(sel.attrib.get('ref')) for sel in el.findall('nd')]
+        self.nodes = nodes
         self.start = self.nodes[0]
         self.end = self.nodes[-1]
+        self.node_pos = None
 
         self.name = self.get_tag('ref')
         self.type = self.get_tag('highway')
 
-        self.add_lanes = 0
-        self.remove_lanes = 0
-
         try:
             self.lanes = int(self.get_tag('lanes'))
         except (TypeError, ValueError):
@@ -123,6 +475,39 @@ class Seg(OsmElm):
             lanedata = self.get_tag(key + ':lanes')
             self.lanedata[key] = lanedata.split('|') if lanedata else None
 
+    @staticmethod
+    def read_nodes(el):
+        return [int(sel.get('ref')) for sel in el.findall('nd')]
+
+    @classmethod
+    def from_xml(cls, el, network):
+        return cls(int(el.get('id')), cls.read_nodes(el), cls.read_tags(el), network)
+
+    # Position of node_id in this segment (first, if it shows up more than
+    # once), or None. Indexed on first use.
+    def find_node(self, node_id):
+        if self.node_pos is None:
+            last = len(self.nodes) - 1
+            self.node_pos = dict(zip(reversed(self.nodes), range(last, -1, -1)))
+        return self.node_pos.get(node_id)
+
+    def __getstate__(self):
+        slots = [s for c in type(self).__mro__ for s in getattr(c, '__slots__', ())]
+        return {
+            s: getattr(self, s) for s in slots
+            if s not in ('network', 'node_pool', 'node_pos') and hasattr(self, s)
+        }
+
+    def __setstate__(self, state):
+        for (k, v) in state.items():
+            setattr(self, k, v)
+
+    # Restore network references after unpickling
+    def attach(self, network):
+        self.network = network
+        self.node_pool = network.nodes
+        self.node_pos = None
+
     def get_name(self):
         name = self.get_tag('name', 'ref')
         if name:
@@ -163,7 +548,7 @@ class Seg(OsmElm):
 
         return self.get_index().lookup_segs(self.start, 'end', hwy)
 
-    def post_process(self, hwyIndex, linkIndex):
+    def post_process(self, node_segs):
         pass
 
     # Calculate the absolute angle of this element
@@ -187,45 +572,75 @@ class Seg(OsmElm):
             return None
 
 class HwySeg(Seg):
-    def __init__(self, el, network):
-        super().__init__(el, network)
+    __slots__ = ('links', 'link_geom', 'junctions')
+
+    def __init__(self, id, nodes, tags, network):
+        super().__init__(id, nodes, tags, network)
 
         self.links = []
+        # link id => (type, relative angle, side), see Network.compute_link_geometry
+        self.link_geom = {}
+        # link id => position of the node the link meets us at
+        self.junctions = {}
 
     def get_index(self):
         return self.network.hwy_segs
 
-    def post_process(self, hwyIndex, linkIndex):
-        super().post_process(hwyIndex, linkIndex)
-
-        # Additionally, connect links
-        self.links = []
-        for l in linkIndex.lookup_all(self.nodes):
-            link = l[1]
-            # On borders:
-            #  - exits get appended to next segment
-            #  - entrances get appended to previous segment
-            if link.start != self.end and link.end != self.start:
-                self.links.append(l)
-
-        # Find connecting highways
-        for l in hwyIndex.lookup_all(self.nodes):
-            link = l[1]
-            # On borders:
-            #  - exits get appended to next segment
-            #  - entrances get appended to previous segment
-            if link.start != self.end and link.end != self.start:
-                self.links.append(l)
+    # Links are pickled as ids, see attach()
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['links'] = [(t, link.id, isinstance(link, HwySeg)) for (t, link) in self.links]
+        return state
+
+    def attach(self, network):
+        super().attach(network)
+        self.links = [
+            (t, (network.hwy_segs if is_hwy else network.link_segs).get(link_id))
+            for (t, link_id, is_hwy) in self.links
+        ]
+
+    def post_process(self, node_segs):
+        super().post_process(node_segs)
+
+        # Additionally, connect links, and then highways without a ref
+        # (named ones are followed as part of their own highway)
+        # Exits start on one of our nodes, entrances end on one
+        links = []
+        hwys = []
+        for node_id in self.nodes:
+            for (link_type, found) in (('exit', node_segs.starting(node_id)), ('entrance', node_segs.ending(node_id))):
+                for link in found:
+                    # On borders:
+                    #  - exits get appended to next segment
+                    #  - entrances get appended to previous segment
+                    if(link is self or link.start == self.end or link.end == self.start):
+                        continue
+                    if isinstance(link, LinkSeg):
+                        links.append((link_type, link))
+                    elif not all(link.get_hwys()):
+                        hwys.append((link_type, link))
+        self.links = links + hwys
+
+        # Work out how each link joins us once, here
+        self.link_geom = {}
+        self.junctions = {}
+        for (t, link) in self.links:
+            (link_type, pos) = self.find_link(link)
+            self.link_geom[link.id] = (link_type, None, None)
+            self.junctions[link.id] = pos
 
     # Get the angle of a link relative to this segment
     def get_rel_ang(self, link):
+        geom = self.link_geom.get(link.id)
+        if geom and geom[1] is not None:
+            return geom[1]
+
         link_type = self.get_link_type(link)
         if(link_type is None):
             return None
 
         rev = (link_type == 'entrance')
-        center_id = link.end if rev else link.start
-        start_node = self.nodes.index(center_id)
+        start_node = self.junctions[link.id] if link.id in self.junctions else self.find_link(link)[1]
         diff = link.get_ang(rev) - self.get_ang(rev, start_node)
 
         if(abs(diff) == math.radians(180)):
@@ -239,27 +654,44 @@ class HwySeg(Seg):
     # Link type depends inherently on what trunk it's with respect to
     # One highway's exit can be another's entrance
     def get_link_type(self, link):
-        if((link.start in self.nodes) and (link.start != self.end)):
-            return 'exit'
-        elif((link.end in self.nodes) and (link.end != self.start)):
-            return 'entrance'
-        else:
-            print(link.start, link.end, file=sys.stderr)
-            print(self.nodes, file=sys.stderr)
-            return None
+        geom = self.link_geom.get(link.id)
+        if geom:
+            return geom[0]
+
+        return self.find_link(link)[0]
+
+    # Returns (link type, position of the junction node)
+    def find_link(self, link):
+        pos = self.find_node(link.start)
+        if((pos is not None) and (link.start != self.end)):
+            return ('exit', pos)
+
+        pos = self.find_node(link.end)
+        if((pos is not None) and (link.end != self.start)):
+            return ('entrance', pos)
+
+        log.debug("Link %s (%s to %s) doesn't join segment %s", link.id, link.start, link.end, self.id)
+        return (None, None)
 
     # Determine left-hand vs right-hand exits
     # Based on angle of exit wrt hwy
     def get_side(self, link):
+        geom = self.link_geom.get(link.id)
+        if geom and geom[2] is not None:
+            return geom[2]
+
         type = self.get_link_type(link)
         if(type is None):
             return None
         else:
-            rel_ang = self.get_rel_ang(link)
-            if(type == 'exit'):
-                return 1 if rel_ang > 0 else -1
-            else:
-                return -1 if rel_ang > 0 else 1
+            return self.side_from_ang(type, self.get_rel_ang(link))
+
+    @staticmethod
+    def side_from_ang(link_type, rel_ang):
+        if(link_type == 'exit'):
+            return 1 if rel_ang > 0 else -1
+        else:
+            return -1 if rel_ang > 0 else 1
 
     def dump_link_nodes(self, types='all'):
         if not isinstance(types, list):
@@ -274,12 +706,19 @@ class HwySeg(Seg):
 
         return nodes
 
+    # Connectors without a ref go by their name, if they have one
     def describe_link(self, trunk):
-        return self.get_hwys()[0]
+        return self.get_hwys()[0] or self.get_name() or '???'
+
+    # Motorways joining as links don't have exit numbers
+    def get_number(self):
+        return None
 
 class LinkSeg(Seg):
-    def __init__(self, el, node_pool):
-        super().__init__(el, node_pool)
+    __slots__ = ('dest', 'source', 'aux_links', 'aux')
+
+    def __init__(self, id, nodes, tags, network):
+        super().__init__(id, nodes, tags, network)
 
         self.dest = None
         self.source = None
@@ -288,13 +727,19 @@ class LinkSeg(Seg):
     def get_index(self):
         return self.network.link_segs
 
+    def attach(self, network):
+        super().attach(network)
+        for aux in self.aux_links.values():
+            aux.attach(network)
+
     def get_junction(self, trunk):
         link_type = trunk.get_link_type(self)
         return self.start if (link_type == 'exit') else self.end
 
     def get_aux(self):
         if self.aux_links.values():
-            self.aux = '/'.join(set([l.get_name() for l in self.aux_links.values() if l.get_name()]))
+            # Deduped in the order the aux ways were read, so labels don't depend on hashing
+            self.aux = '/'.join(dict.fromkeys(l.get_name() for l in self.aux_links.values() if l.get_name()))
             return self.aux
         else:
             return None
@@ -338,6 +783,11 @@ class LinkSeg(Seg):
     def get_number(self):
         return self.node_pool[self.start].name
 
+# One segment along a compiled route (see Hwy.compile)
+# lanes includes any lanes carried over from splits earlier on
+RouteStep = namedtuple('RouteStep', ['seg', 'lanes', 'links'])
+RouteLink = namedtuple('RouteLink', ['type', 'link', 'side', 'number', 'desc'])
+
 class Hwy:
     def __init__(self, name, parent):
         self.name = name
@@ -345,6 +795,7 @@ class Hwy:
         self.starts = []
         self.ends = []
         self.parent = parent
+        self.plan = None
 
     def add_seg(self, seg):
         if(seg.is_start(self.name)):
@@ -352,39 +803,58 @@ class Hwy:
         elif(seg.is_end(self.name)):
             self.ends.append(seg)
 
-    def lookup(self, node_id, idx_key):
-        idx = self.parent.seg_pool
-        segs = idx.lookup_segs(node_id, idx_key, self.name)
-
+    # Segments of this highway starting (or ending) at node_id
+    # Returns the trunk (the one with the most lanes) and the other branches
+    def branches(self, node_id, idx_key):
+        segs = self.parent.seg_pool.lookup_segs(node_id, idx_key, self.name)
         if not len(segs):
-            return None
+            return (None, [])
 
-        # Merge segments as necessary
         trunk = max(segs, key=lambda s: s.lanes)
-        for branch in segs:
-            if branch == trunk:
-                continue
-            trunk = self.merge_lanes(trunk, branch, idx_key)
-
-        return trunk
-
-    # TODO: Do we need to worry about segments in the middle here?
-    def merge_lanes(self, main, branch, merge_point):
-        branch.discard = True
-        if(merge_point == 'start'):
-            # Start of split lanes, add all previous lanes to our additional lanes
-            main.add_lanes = branch.lanes + branch.add_lanes
-        else:
-            # End of split, we're downsizing
-            main.remove_lanes = branch.lanes + branch.remove_lanes
-
-        return main
-
-    def next(self, relseg):
-        return self.lookup(relseg.end, 'start')
-
-    def prev(self, relseg):
-        return self.lookup(relseg.start, 'end')
+        return (trunk, [s for s in segs if s != trunk])
+
+    # The route from each start, worked out once and shared by every render
+    def get_plan(self):
+        if self.plan is None:
+            self.plan = self.compile()
+        return self.plan
+
+    # Walk each start along its trunk, into a tuple of RouteSteps
+    # Lanes picked up from branches are tracked here, by segment id,
+    # so compiling doesn't change anything
+    def compile(self):
+        add_lanes = {}
+        routes = []
+        for start in self.starts:
+            steps = []
+            seen = set()
+            extra_lanes = 0
+            curseg = start
+            while curseg:
+                if curseg.id in seen:
+                    log.warning("Highway %s loops back on segment %s", self.name, curseg.id)
+                    break
+                seen.add(curseg.id)
+
+                extra_lanes += add_lanes.get(curseg.id, 0)
+                steps.append(RouteStep(curseg, curseg.lanes + extra_lanes, self.compile_links(curseg)))
+
+                (curseg, branches) = self.branches(curseg.end, 'start')
+                if branches:
+                    # Start of split lanes, the trunk picks up the last branch's lanes
+                    branch = branches[-1]
+                    add_lanes[curseg.id] = branch.lanes + add_lanes.get(branch.id, 0)
+
+            routes.append(tuple(steps))
+
+        return tuple(routes)
+
+    @staticmethod
+    def compile_links(seg):
+        return tuple(
+            RouteLink(type, link, seg.get_side(link), link.get_number(), link.describe_link(seg))
+            for (type, link) in seg.links
+        )
 
 class HwySet:
     def __init__(self, segs):
@@ -406,22 +876,125 @@ class HwySet:
     def get_hwy(self, name):
         return self.hwys[name]
 
+# Module-level (rather than a lambda) so SegIndexes can be pickled
+def node_index():
+    return defaultdict(set)
+
+# Every node of every motorway and link segment => the (segment, position)
+# pairs it appears at, so junctions anywhere along a segment can be found
+# without scanning
+# Segments from pending (SegIndexes) are added on first lookup
+class NodeSegIndex:
+    def __init__(self, pending = ()):
+        self.nodes = {}
+        self.pending = list(pending)
+
+    def add_pending(self):
+        for idx in self.pending:
+            for seg in idx.segs.values():
+                self.add(seg)
+        self.pending = []
+
+    def add(self, seg):
+        for (pos, node_id) in enumerate(seg.nodes):
+            found = self.nodes.get(node_id)
+            if found is None:
+                self.nodes[node_id] = [(seg, pos)]
+            else:
+                found.append((seg, pos))
+
+    def lookup(self, node_id):
+        if self.pending:
+            self.add_pending()
+        return self.nodes.get(int(node_id), ())
+
+    def starting(self, node_id):
+        return [seg for (seg, pos) in self.lookup(node_id) if pos == 0]
+
+    def ending(self, node_id):
+        return [seg for (seg, pos) in self.lookup(node_id) if pos == len(seg.nodes) - 1]
+
+    # Ids of the links carrying on from link towards its start or end:
+    # ones it runs into at its far node, plus ones that branch off (or
+    # merge in) partway along. Also returns whether anything carries on
+    # from the far node, if not the link is the last in its chain.
+    def branches(self, link, towards):
+        forwards = (towards == 'end')
+        last = len(link.nodes) - 1
+        (far, near) = (last, 0) if forwards else (0, last)
+        continues = False
+        next_ids = []
+        for (pos, node_id) in enumerate(link.nodes):
+            # Links sharing our near node are siblings, not branches
+            if(pos == near):
+                continue
+            for (seg, seg_pos) in self.lookup(node_id):
+                if(seg is link or not isinstance(seg, LinkSeg)):
+                    continue
+                seg_last = len(seg.nodes) - 1
+                if(pos == far):
+                    # Whatever we run into carries on, unless it stops here too
+                    joined = (seg_pos != (seg_last if forwards else 0))
+                    continues = continues or joined
+                else:
+                    # Partway along, only links leaving (or joining) us
+                    joined = (seg_pos == (0 if forwards else seg_last))
+                if joined:
+                    next_ids.append(seg.id)
+
+        return (continues, next_ids)
+
+# Array-backed stand-in for one {node id: set of segment ids} index
+# (see SegIndex.freeze) in CSR form: node ids are sorted and resolved by
+# binary search, and the segment ids for keys[i] are
+# values[offsets[i]:offsets[i+1]]
+class FrozenNodeIndex:
+    def __init__(self, index):
+        keys = sorted(index)
+        self.keys = np.array(keys, dtype=np.int64)
+        self.offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(index[k]) for k in keys], out=self.offsets[1:])
+        # Sets keep their iteration order, so lookups come back in the same order
+        self.values = np.fromiter(
+            (seg_id for k in keys for seg_id in index[k]),
+            dtype=np.int64, count=int(self.offsets[-1])
+        )
+
+    # The ndarray methods skip the dispatch np.searchsorted() goes through,
+    # which is most of the cost of a single lookup
+    def get(self, node_id, default = None):
+        row = int(self.keys.searchsorted(node_id))
+        if row < len(self.keys) and self.keys.item(row) == node_id:
+            return self.values[self.offsets.item(row):self.offsets.item(row+1)].tolist()
+
+        return default
+
+    def __len__(self):
+        return len(self.keys)
+
 class SegIndex:
     no_seg = '_all_'
 
     def __init__(self, partition_by = None):
         self.segs = {}
         self.indexes = {
-            'start': defaultdict(lambda: defaultdict(set)),
-            'end': defaultdict(lambda: defaultdict(set)),
+            'start': defaultdict(node_index),
+            'end': defaultdict(node_index),
         }
         self.partition_by = partition_by
+        # (link id, direction) => segments at the end of the chain
+        self.lasts = {}
+        self.frozen = False
 
     def get(self, id):
         return self.segs[id]
 
     def add(self, seg):
+        if self.frozen:
+            raise RuntimeError("Can't add segments to a frozen SegIndex")
+
         self.segs[seg.id] = seg
+        self.lasts.clear()
 
         for idx_key in self.indexes:
             if(self.partition_by):
@@ -449,9 +1022,26 @@ class SegIndex:
             partition = self.no_seg
 
         node_id = int(node_id)
-        lookup = self.indexes[idx][partition]
+        # Misses mustn't add empty entries to the index
+        lookup = self.indexes[idx].get(partition)
+        if lookup is None:
+            return ()
 
-        return lookup[node_id]
+        return lookup.get(node_id, ())
+
+    # Pack the indexes into sorted arrays once everything's been added
+    # A set per node adds up on large extracts
+    def freeze(self):
+        if self.frozen:
+            return
+        if np is None:
+            raise RuntimeError("Compact segment indexes require numpy")
+
+        self.indexes = {
+            idx_key: {part_val: FrozenNodeIndex(index) for (part_val, index) in partitions.items()}
+            for (idx_key, partitions) in self.indexes.items()
+        }
+        self.frozen = True
 
     def lookup_segs(self, node_id, idx, partition=None):
         id_list = self.lookup(node_id, idx, partition)
@@ -471,26 +1061,41 @@ class SegIndex:
 
         return matches
 
-    # TODO: This doesn't work if branches don't happen at the end
-    # Which definitely happens
-    def lookup_last(self, link_id, towards, seen_ids = []):
-        outlinks = set()
+    # Follow a chain of links towards its start or end,
+    # returning the segment(s) at the far end of every branch
+    # Branches can leave (or join) partway along a link, not just at its
+    # ends, so they're found through the network's node index
+    # Results are memoized per (link, direction) - see precompute_lasts
+    def lookup_last(self, link_id, towards):
+        key = (link_id, towards)
+        if key in self.lasts:
+            return self.lasts[key]
 
-        if link_id in seen_ids:
-            print("I seem to have found a loop...", file=sys.stderr)
-            print(seen_ids, file=sys.stderr)
-            return []
-        seen_ids.append(link_id)
+        outlinks = set()
+        seen_ids = {link_id}
+        stack = [link_id]
+        while stack:
+            cur_id = stack.pop()
+            memo = self.lasts.get((cur_id, towards))
+            if memo is not None:
+                outlinks.update(memo)
+                continue
 
-        cur_link = self.get(link_id)
-        next_node = getattr(cur_link, towards)
-        print("Looking for {} of segment {} at {}...".format(towards, link_id, next_node), file=sys.stderr)
-        next_links = self.lookup(next_node, 'end' if towards == 'start' else 'start')
+            cur_link = self.get(cur_id)
+            (continues, next_links) = cur_link.network.node_segs.branches(cur_link, towards)
+            if not continues:
+                outlinks.add(cur_link)
 
-        if len(next_links):
             for l in next_links:
-                outlinks.update(self.lookup_last(l, towards, seen_ids))
-        else:
-            return [cur_link]
-
-        return outlinks
+                # Loops (and merges) just stop at segments we've already seen
+                if l not in seen_ids:
+                    seen_ids.add(l)
+                    stack.append(l)
+
+        self.lasts[key] = tuple(outlinks)
+        return self.lasts[key]
+
+    def precompute_lasts(self, directions = ('start', 'end')):
+        for towards in directions:
+            for link_id in self.segs:
+                self.lookup_last(link_id, towards)
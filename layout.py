@@ -0,0 +1,196 @@
+import json
+import logging
+from array import array
+from collections import namedtuple
+
+# Lays out compiled highway routes (see hwy.Hwy.compile) as rows of lanes
+# Everything about where things go is decided here: buffer rows, which
+# way up the highway goes, which links cap off lanes, and lane offsets.
+# Rendering is left to just draw it.
+
+# A ramp drawn on a row, with its label
+LinkRecord = namedtuple('LinkRecord', ['type', 'side', 'number', 'desc'])
+
+no_links = ()
+
+log = logging.getLogger('layout')
+
+# Rows are stored column-wise: lane counts, offsets and unaccounted-for
+# lane changes in arrays, and each row's links (and which of them cap
+# off a lane) in lists, mostly pointing at the same empty tuple
+class Layout:
+    def __init__(self):
+        self.lanes = array('i')
+        self.offsets = array('i')
+        self.lane_diffs = array('i')
+        self.links = []
+        self.caps = []
+        self.flipped = False
+
+    def __len__(self):
+        return len(self.lanes)
+
+    def add_row(self, lanes, links = no_links):
+        self.lanes.append(lanes)
+        self.offsets.append(0)
+        self.lane_diffs.append(0)
+        self.links.append(links)
+        self.caps.append(no_links)
+
+    # Flip the rows if exit numbers count down the page
+    def orient(self):
+        exit_nums = []
+        for links in self.links:
+            try:
+                exit_nums.append(int(links[0].number))
+            except (IndexError, TypeError, ValueError):
+                pass
+
+        total_diff = 0
+        for i in range(len(exit_nums)-1):
+            total_diff += exit_nums[i] - exit_nums[i+1]
+
+        if(total_diff < 0):
+            for col in (self.lanes, self.links):
+                col.reverse()
+            self.flipped = True
+
+    # Plain data for JSON, see dump()
+    def to_dict(self):
+        return {
+            'flipped': self.flipped,
+            'lanes': self.lanes.tolist(),
+            'offsets': self.offsets.tolist(),
+            'lane_diffs': self.lane_diffs.tolist(),
+            'links': [[link._asdict() for link in links] for links in self.links],
+            'caps': [list(caps) for caps in self.caps],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        layout = cls()
+        layout.flipped = d['flipped']
+        layout.lanes = array('i', d['lanes'])
+        layout.offsets = array('i', d['offsets'])
+        layout.lane_diffs = array('i', d['lane_diffs'])
+        layout.links = [tuple(LinkRecord(**link) for link in links) if links else no_links for links in d['links']]
+        layout.caps = [tuple(caps) if caps else no_links for caps in d['caps']]
+        return layout
+
+    def add_cap(self, idx, link_idx):
+        self.caps[idx] = self.caps[idx] + (link_idx,)
+
+    # Work out each row's offset from the one before it
+    def place(self):
+        flip = 1 if self.flipped else -1
+        (adder, remover) = ('exit', 'entrance') if self.flipped else ('entrance', 'exit')
+        for idx in range(len(self)-1):
+            next_idx = idx + 1
+            # Is there a difference in lanes between this lane and next?
+            lane_diff = self.lanes[next_idx] - self.lanes[idx]
+            lane_adj = 0
+
+            # Check if we already have something that adds a lane
+            # (Entrances, or Exits for flipped highways)
+            for (link_idx, link) in enumerate(self.links[idx]):
+                # If we have one and need a lane added, use it
+                if(link.type == adder and lane_diff > 0):
+                    self.add_cap(idx, link_idx)
+                    lane_diff-=1
+                    # If it's a left-side lane, it'll eat up one col of offset
+                    if(link.side != flip):
+                        lane_adj -= 1
+            # ...and, in the next lane, for something that removes a lane
+            for (link_idx, link) in enumerate(self.links[next_idx]):
+                if(link.type == remover and lane_diff < 0):
+                    self.add_cap(next_idx, link_idx)
+                    lane_diff+=1
+                    # Left-side removers will leave empty below them, adding a col of offset
+                    if(link.side != flip):
+                        lane_adj += 1
+
+            # If we still have a difference, note it so we can add a joiner
+            if(lane_diff):
+                self.lane_diffs[next_idx if lane_diff < 0 else idx] = lane_diff
+
+            # TODO: This will always eliminate rightmost lanes
+            # Sometimes we might know that it's the left lane instead?
+            self.offsets[next_idx] = self.offsets[idx] + lane_adj
+
+def layout_route(route):
+    layout = Layout()
+    # Checked once, so the per-row messages cost nothing when they're off
+    debug = log.isEnabledFor(logging.DEBUG)
+
+    lastlanes = route[0].seg.lanes
+    link_add = 0
+    link_sub = 0
+    for step in route:
+        curlanes = step.lanes
+        if debug:
+            log.debug("Lanes/links: %s %s %s", lastlanes, curlanes, len(step.links))
+        if(lastlanes != curlanes or len(step.links)):
+            lane_diff = (curlanes - lastlanes)
+
+            if(len(step.links)):
+                for (idx, link) in enumerate(step.links):
+                    # Exits apply to this row
+                    if(link.type == 'exit'):
+                        link_sub = 1
+                    else:
+                        link_sub = 0
+
+                    if debug:
+                        log.debug("%s", link.desc)
+                        log.debug("Diff: %s %s %s", lane_diff, -link_sub, link_add)
+                    # Add an extra row if we have lane changes
+                    # that aren't accounted for by exits/entrances
+                    if(idx == 0):
+                        if(lane_diff < 0 and -lane_diff > link_sub):
+                            if debug:
+                                log.debug("Adding buffer row...")
+                            layout.add_row(curlanes)
+                        elif(lane_diff > 0 and lane_diff > link_add):
+                            if debug:
+                                log.debug("Adding buffer row...")
+                            layout.add_row(lastlanes)
+
+                    layout.add_row(curlanes, (LinkRecord(link.type, link.side, link.number, link.desc),))
+
+                    # Entrances apply to next row
+                    if(link.type == 'entrance'):
+                        link_add = 1
+                    else:
+                        link_add = 0
+
+                    # Update lastlanes for entrance rendering
+                    lastlanes = curlanes
+            else:
+                if(lane_diff < 0 and -lane_diff > link_sub):
+                    if debug:
+                        log.debug("Adding buffer row...")
+                    layout.add_row(curlanes)
+                elif(lane_diff > 0 and lane_diff > link_add):
+                    if debug:
+                        log.debug("Adding buffer row...")
+                    layout.add_row(lastlanes)
+
+                layout.add_row(curlanes)
+
+        lastlanes = curlanes
+
+    layout.orient()
+    layout.place()
+    return layout
+
+# One Layout per start of the highway
+def layout_hwy(hwy):
+    return [layout_route(route) for route in hwy.get_plan()]
+
+# Layouts don't depend on styling, so they can be saved and drawn later
+def dump(layouts, f):
+    json.dump({'highways': [l.to_dict() for l in layouts]}, f)
+    f.write('\n')
+
+def load(f):
+    return [Layout.from_dict(d) for d in json.load(f)['highways']]
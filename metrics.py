@@ -0,0 +1,137 @@
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Wall and CPU time, plus counts of whatever was processed, for each stage
+# of a run (parsing, linking, layout, rendering...)
+# Stages are only kept after enable() (--metrics), so long-running
+# processes like the server don't pile them up. Tracing memory and
+# profiling slow everything down a lot, so they're only done after
+# enable_profiling() (--profile), and only for outermost stages.
+#
+#   with metrics.stage('layout') as st:
+#       ...
+#       st.count(rows=n)
+
+stages = []
+recording = False
+profile_dir = None
+depth = 0
+
+def cpu_times():
+    # Children includes pool workers, once they've been waited on
+    t = os.times()
+    return (time.process_time(), t.children_user + t.children_system)
+
+class Stage:
+    def __init__(self, name):
+        global depth
+        self.name = name
+        self.counts = {}
+        self.outer = (depth == 0)
+        self.profiler = None
+        depth += 1
+
+        if(self.outer and tracemalloc.is_tracing()):
+            tracemalloc.reset_peak()
+        if(self.outer and profile_dir):
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        self.wall = time.perf_counter()
+        (self.cpu, self.child_cpu) = cpu_times()
+        self.done = False
+
+    def count(self, **counts):
+        for (key, n) in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + n
+
+    def end(self):
+        global depth
+        if self.done:
+            return
+        self.done = True
+        depth -= 1
+        if not recording:
+            return
+
+        (cpu, child_cpu) = cpu_times()
+        record = {
+            'name': self.name,
+            'depth': depth,
+            'wall': time.perf_counter() - self.wall,
+            'cpu': cpu - self.cpu,
+            'child_cpu': child_cpu - self.child_cpu,
+            'counts': self.counts,
+        }
+
+        if(self.outer and tracemalloc.is_tracing()):
+            (record['mem'], record['peak_mem']) = tracemalloc.get_traced_memory()
+        if self.profiler:
+            self.profiler.disable()
+            filename = '{:02d}-{}.pstats'.format(len(stages), self.name.replace(' ', '_'))
+            self.profiler.dump_stats(os.path.join(profile_dir, filename))
+            record['profile'] = filename
+
+        stages.append(record)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.end()
+
+def stage(name):
+    return Stage(name)
+
+def enable():
+    global recording
+    recording = True
+
+# Stages recorded since there were first_idx of them, removed from ours
+# Pool workers hand these back for the parent to merge()
+def take(first_idx):
+    taken = stages[first_idx:]
+    del stages[first_idx:]
+    return taken
+
+def merge(records):
+    stages.extend(records)
+
+# Trace memory and dump a cProfile of each stage into path
+def enable_profiling(path):
+    global profile_dir
+    os.makedirs(path, exist_ok=True)
+    profile_dir = path
+    tracemalloc.start()
+    enable()
+
+def report():
+    totals = {
+        'wall': sum(s['wall'] for s in stages if s['depth'] == 0),
+        'cpu': sum(s['cpu'] for s in stages if s['depth'] == 0),
+        'child_cpu': sum(s['child_cpu'] for s in stages if s['depth'] == 0),
+    }
+    if resource:
+        # kB on Linux, bytes on macOS
+        totals['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+        'argv': sys.argv,
+        'python': sys.version.split()[0],
+        'stages': stages,
+        'totals': totals,
+    }
+
+def write_report(filename):
+    with open(filename, 'w') as f:
+        json.dump(report(), f, indent=2)
+        f.write('\n')
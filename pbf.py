@@ -0,0 +1,315 @@
+import lzma
+import os
+import struct
+import zlib
+from itertools import accumulate
+from multiprocessing import Pool
+
+# Minimal reader for OSM .osm.pbf files
+# See https://wiki.openstreetmap.org/wiki/PBF_Format
+# Only the bits we need are decoded (no metadata, no relations), and
+# blocks are decoded in parallel across a process pool. Worker processes
+# read their blocks straight from the file, so only the (filtered) results
+# get shipped back to the parent.
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not (b & 0x80):
+            return (result, pos)
+        shift += 7
+
+def zigzag(val):
+    return (val >> 1) ^ -(val & 1)
+
+# Negative int64s are encoded as 10-byte two's complement varints
+def signed(val):
+    return val - (1 << 64) if val >= (1 << 63) else val
+
+def iter_fields(buf):
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        (key, pos) = read_varint(buf, pos)
+        (field, wire_type) = (key >> 3, key & 0x7)
+        if wire_type == 0:
+            (val, pos) = read_varint(buf, pos)
+        elif wire_type == 2:
+            (size, pos) = read_varint(buf, pos)
+            val = buf[pos:pos+size]
+            pos += size
+        elif wire_type == 1:
+            val = buf[pos:pos+8]
+            pos += 8
+        elif wire_type == 5:
+            val = buf[pos:pos+4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire_type))
+
+        yield (field, wire_type, val)
+
+def unpack_varints(buf):
+    out = []
+    val = 0
+    shift = 0
+    for b in buf:
+        val |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            out.append(val)
+            val = 0
+            shift = 0
+
+    return out
+
+# Repeated scalar fields are normally packed, but we're allowed to
+# get them one at a time too
+def repeated(wire_type, val):
+    return unpack_varints(val) if wire_type == 2 else [val]
+
+def iter_blocks(filename):
+    with open(filename, 'rb') as f:
+        while True:
+            head = f.read(4)
+            if len(head) < 4:
+                break
+
+            (header_len,) = struct.unpack('>I', head)
+            block_type = None
+            data_size = 0
+            for (field, _, val) in iter_fields(memoryview(f.read(header_len))):
+                if field == 1:
+                    block_type = bytes(val).decode()
+                elif field == 3:
+                    data_size = val
+
+            offset = f.tell()
+            if block_type == 'OSMData':
+                yield (offset, data_size)
+            f.seek(data_size, os.SEEK_CUR)
+
+def read_blob(filename, offset, size):
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        blob = f.read(size)
+
+    for (field, _, val) in iter_fields(memoryview(blob)):
+        if field == 1:
+            return val
+        elif field == 3:
+            return memoryview(zlib.decompress(val))
+        elif field == 4:
+            return memoryview(lzma.decompress(val))
+        elif field in (5, 6, 7):
+            raise ValueError("Unsupported PBF blob compression")
+
+    return memoryview(b'')
+
+class Block:
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+
+        for (field, wire_type, val) in iter_fields(data):
+            if field == 1:
+                self.strings = [bytes(s).decode() for (_, _, s) in iter_fields(val)]
+            elif field == 2:
+                self.groups.append(val)
+            elif field == 17:
+                self.granularity = val
+            elif field == 19:
+                self.lat_offset = signed(val)
+            elif field == 20:
+                self.lon_offset = signed(val)
+
+    def coord(self, offset, val):
+        return (offset + self.granularity*val)/1000000000
+
+    def tags(self, keys, vals):
+        return {self.strings[k]: self.strings[v] for (k, v) in zip(keys, vals)}
+
+    def has_nodes(self):
+        return any(field in (1, 2) for group in self.groups for (field, _, _) in iter_fields(group))
+
+    # keep is a WayFilter
+    # Most ways get thrown out on their tags alone, so refs (the bulk of
+    # each way) are only decoded for ways that get past keep.tags_match()
+    def ways(self, keep):
+        for group in self.groups:
+            for (field, _, way) in iter_fields(group):
+                if field != 3:
+                    continue
+
+                way_id = 0
+                keys = []
+                vals = []
+                packed_refs = []
+                for (wfield, wire_type, val) in iter_fields(way):
+                    if wfield == 1:
+                        way_id = signed(val)
+                    elif wfield == 2:
+                        keys += repeated(wire_type, val)
+                    elif wfield == 3:
+                        vals += repeated(wire_type, val)
+                    elif wfield == 8:
+                        packed_refs.append((wire_type, val))
+
+                tags = self.tags(keys, vals)
+                if not keep.tags_match(tags):
+                    continue
+
+                refs = list(accumulate(
+                    zigzag(r) for (wire_type, val) in packed_refs for r in repeated(wire_type, val)
+                ))
+                if keep.refs_match(refs):
+                    yield (way_id, refs, tags)
+
+    def nodes(self, keep):
+        for group in self.groups:
+            for (field, _, val) in iter_fields(group):
+                if field == 1:
+                    yield from self.plain_node(val, keep)
+                elif field == 2:
+                    yield from self.dense_nodes(val, keep)
+
+    def plain_node(self, node, keep):
+        node_id = lat = lon = 0
+        keys = []
+        vals = []
+        for (field, wire_type, val) in iter_fields(node):
+            if field == 1:
+                node_id = zigzag(val)
+            elif field == 2:
+                keys += repeated(wire_type, val)
+            elif field == 3:
+                vals += repeated(wire_type, val)
+            elif field == 8:
+                lat = zigzag(val)
+            elif field == 9:
+                lon = zigzag(val)
+
+        if keep(node_id):
+            yield (
+                node_id,
+                self.coord(self.lat_offset, lat),
+                self.coord(self.lon_offset, lon),
+                self.tags(keys, vals)
+            )
+
+    def dense_nodes(self, dense, keep):
+        ids = lats = lons = keys_vals = []
+        for (field, wire_type, val) in iter_fields(dense):
+            if field == 1:
+                ids = repeated(wire_type, val)
+            elif field == 8:
+                lats = repeated(wire_type, val)
+            elif field == 9:
+                lons = repeated(wire_type, val)
+            elif field == 10:
+                keys_vals = repeated(wire_type, val)
+
+        ids = accumulate(zigzag(i) for i in ids)
+        lats = accumulate(zigzag(i) for i in lats)
+        lons = accumulate(zigzag(i) for i in lons)
+
+        # keys_vals is a flat list of key, val, key, val, 0, key, val, 0...
+        # with a 0 terminating each node's tags (and empty if no nodes have tags)
+        kv_pos = 0
+        for (node_id, lat, lon) in zip(ids, lats, lons):
+            tag_start = kv_pos
+            while kv_pos < len(keys_vals) and keys_vals[kv_pos] != 0:
+                kv_pos += 2
+
+            if keep(node_id):
+                yield (
+                    node_id,
+                    self.coord(self.lat_offset, lat),
+                    self.coord(self.lon_offset, lon),
+                    self.tags(keys_vals[tag_start:kv_pos:2], keys_vals[tag_start+1:kv_pos:2])
+                )
+            kv_pos += 1
+
+class WayFilter:
+    # highways: only keep ways with one of these highway= values
+    # node_refs: only keep ways that reference at least one of these nodes
+    # drop_highways: never keep ways with these highway= values
+    def __init__(self, highways = None, node_refs = None, drop_highways = ()):
+        self.highways = set(highways) if highways is not None else None
+        self.node_refs = frozenset(node_refs) if node_refs is not None else None
+        self.drop_highways = set(drop_highways)
+
+    def tags_match(self, tags):
+        highway = tags.get('highway')
+        if self.highways is not None and highway not in self.highways:
+            return False
+        if highway in self.drop_highways:
+            return False
+
+        return True
+
+    def refs_match(self, refs):
+        return self.node_refs is None or not self.node_refs.isdisjoint(refs)
+
+    def __call__(self, refs, tags):
+        return self.tags_match(tags) and self.refs_match(refs)
+
+# Set once per worker by the pool initializer, so big filters
+# (like sets of node ids) don't get pickled with every job
+_filter = None
+
+def _init_worker(filter):
+    global _filter
+    _filter = filter
+
+def _decode_ways(job):
+    block = Block(read_blob(*job))
+    return (list(block.ways(_filter)), block.has_nodes())
+
+def _decode_nodes(job):
+    block = Block(read_blob(*job))
+    return list(block.nodes(_filter))
+
+class Reader:
+    def __init__(self, filename, jobs = None):
+        self.filename = filename
+        self.jobs = jobs or os.cpu_count() or 1
+        self.blocks = list(iter_blocks(filename))
+        self.node_blocks = self.blocks
+
+    def map(self, func, filter, blocks):
+        jobs = [(self.filename, offset, size) for (offset, size) in blocks]
+        if self.jobs == 1 or len(jobs) <= 1:
+            _init_worker(filter)
+            yield from map(func, jobs)
+        else:
+            chunksize = max(1, len(jobs)//(self.jobs*4))
+            with Pool(self.jobs, _init_worker, (filter,)) as pool:
+                yield from pool.imap(func, jobs, chunksize)
+
+    # Decode all ways matching filter, as (id, node refs, tags)
+    # Also notes which blocks have nodes, so nodes() can skip the rest
+    def ways(self, filter):
+        ways = []
+        node_blocks = []
+        for (block, (block_ways, has_nodes)) in zip(self.blocks, self.map(_decode_ways, filter, self.blocks)):
+            ways += block_ways
+            if has_nodes:
+                node_blocks.append(block)
+
+        self.node_blocks = node_blocks
+        return ways
+
+    # Decode nodes with the given ids, as (id, lat, lon, tags)
+    def nodes(self, node_ids):
+        node_ids = frozenset(node_ids)
+        for block_nodes in self.map(_decode_nodes, node_ids.__contains__, self.node_blocks):
+            yield from block_nodes
@@ -2,17 +2,191 @@ import svgwrite
 from svgwrite import mm
 from math import copysign
 import symbols as sym
+import fastsvg
+import gzip
+import io
+from multiprocessing import Pool
+import os
 import re
+import sys
 
 class Diagram:
     text_buffer = 5
     hwy_spacing = 750
-    def __init__(self, gridsize):
+    # Rows per chunk when streaming SVGs
+    chunk_size = 256
+    # 'fast' skips svgwrite's validation and pretty-printing, same output
+    backends = {
+        'svgwrite': lambda: svgwrite.Drawing(debug=True),
+        'fast': fastsvg.Drawing,
+    }
+    def __init__(self, gridsize, backend = 'svgwrite'):
         self.gs = gridsize
-        self.svg = svgwrite.Drawing(debug=True)
+        self.svg = self.backends[backend]()
         self.hwys = []
         self.hwy_offset = int(self.hwy_spacing/gridsize)
         self.cur_horiz = self.hwy_offset
+        # id => pattern, see lane_pattern()
+        self.lane_patterns = {}
+
+        # Written straight into the defs by write_defs()
+        self.symbols = SymbolLibrary.get(backend)
+
+    # Pattern of a full row of num_lanes plain lanes, for drawing runs of rows
+    # as a single element. Built the first time it's asked for, and written
+    # out with the symbols by write_defs()
+    def lane_pattern(self, num_lanes):
+        pattern_id = 'lanes_{}'.format(num_lanes)
+        if pattern_id in self.lane_patterns:
+            return pattern_id
+
+        # Leave room for the outside half of the edge lines
+        edge = Lane.line_width/2
+        pattern = self.svg.pattern(
+            insert=(-edge, 0), size=(num_lanes + 2*edge, 1),
+            id=pattern_id, patternUnits='userSpaceOnUse'
+        )
+        for pos in range(num_lanes):
+            pattern.add(self.svg.use(
+                '#lane_' + Lane.edge_name[Lane.edge_at(pos, num_lanes)],
+                (edge + pos, 0)
+            ))
+        self.lane_patterns[pattern_id] = pattern
+
+        return pattern_id
+
+    def add_hwy(self):
+        hwy = Highway(self)
+        self.cur_horiz += self.hwy_offset
+        self.hwys.append(hwy)
+        return hwy
+
+    # Add a highway laid out by layout.layout_route()
+    # Its rows are only built as they're rendered (see Highway.row())
+    def add_layout(self, layout):
+        hwy = self.add_hwy()
+        hwy.layout = layout
+        hwy.flipped = layout.flipped
+        return hwy
+
+    # Everything rendering SVG rows needs settled up front, so rows can be
+    # rendered in any order (or in parallel, see stream())
+    def prepare(self):
+        self.max_height = max((len(hwy) for hwy in self.hwys), default=0)
+        self.prepare_patterns()
+
+    # Only SVGs draw runs of plain rows with patterns, text doesn't need them
+    def prepare_patterns(self):
+        for hwy in self.hwys:
+            for (first, end) in hwy.iter_groups():
+                if(end - first > 1):
+                    self.lane_pattern(hwy.layout.lanes[first])
+
+    # Text output goes to outfile as it's rendered
+    # (SVGs are written out with stream())
+    def render(self, outfile = sys.stdout):
+        for hwy in self.hwys:
+            hwy.render(lambda row: print(row, file=outfile))
+            print('='*(self.hwy_offset+self.text_buffer), file=outfile)
+
+    # Write the SVG out a chunk of rows at a time, rather than building up
+    # the whole document and writing it at the end
+    # The size only depends on the layout, so the header can go first
+    # With more than one job (None is one per core), chunks are rendered
+    # across a process pool (and still written out in order, so the
+    # output's the same). On a single core that's just overhead.
+    def stream(self, outfile, jobs = 1):
+        self.prepare()
+        outfile.write(fastsvg.Drawing.header)
+        root = fastsvg.Drawing(height=self.max_height*self.gs, width=self.cur_horiz*self.gs)
+        outfile.write(root.open_tag() + '>\n')
+        self.write_defs(outfile)
+
+        chunks = self.chunk_rows()
+        jobs = jobs or os.cpu_count() or 1
+        if(jobs > 1 and len(chunks) > 1):
+            with Pool(jobs, init_emitter, (self,)) as pool:
+                for rendered in pool.imap(emit_chunk, chunks):
+                    outfile.write(rendered)
+        else:
+            for chunk in chunks:
+                outfile.write(self.render_chunk(*chunk))
+
+        outfile.write('</svg>\n')
+
+    # Split each highway into (highway index, first row, end row) chunks of
+    # about chunk_size rows, without splitting up any groups
+    def chunk_rows(self):
+        chunks = []
+        for hwy in self.hwys:
+            chunk_first = 0
+            for (first, end) in hwy.iter_groups():
+                if(end - chunk_first >= self.chunk_size):
+                    chunks.append((hwy.idx, chunk_first, end))
+                    chunk_first = end
+            if(chunk_first < len(hwy)):
+                chunks.append((hwy.idx, chunk_first, len(hwy)))
+
+        return chunks
+
+    def render_chunk(self, hwy_idx, first, end):
+        buf = io.StringIO()
+        hwy = self.hwys[hwy_idx]
+        for (group_first, group_end) in hwy.iter_groups(first, end):
+            self.write_element(buf, hwy.render_group(group_first, group_end))
+
+        return buf.getvalue()
+
+    # The shared symbols are already serialized, only the patterns are
+    # this diagram's own
+    def write_defs(self, outfile):
+        outfile.write('  <defs>\n')
+        outfile.write(self.symbols.text)
+        for pattern in self.lane_patterns.values():
+            self.write_element(outfile, pattern, 2)
+        outfile.write('  </defs>\n')
+
+    @staticmethod
+    def write_element(outfile, el, level = 1):
+        if hasattr(el, 'serialize'):
+            out = []
+            el.serialize(out, True, level)
+            outfile.write(''.join(out))
+        else:
+            # svgwrite elements only do compact output
+            outfile.write('  '*level + el.tostring() + '\n')
+
+    # .svgz files are gzipped as they're written
+    # No timestamp or name in the gzip header, so they're reproducible too
+    def save(self, filename, jobs = 1):
+        if(filename.endswith('.svgz')):
+            with open(filename, 'wb') as raw:
+                with gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0) as gz:
+                    with io.TextIOWrapper(gz, encoding='utf-8') as f:
+                        self.stream(f, jobs)
+        else:
+            with open(filename, 'w', encoding='utf-8') as f:
+                self.stream(f, jobs)
+
+    def tostring(self):
+        buf = io.StringIO()
+        self.stream(buf)
+        return buf.getvalue()
+
+# Symbol definitions only depend on the backend, so they're built (and
+# serialized) once per process and shared by every Diagram
+class SymbolLibrary:
+    libraries = {}
+
+    @classmethod
+    def get(cls, backend):
+        if backend not in cls.libraries:
+            cls.libraries[backend] = cls(backend)
+        return cls.libraries[backend]
+
+    def __init__(self, backend):
+        self.svg = Diagram.backends[backend]()
+        self.elements = []
 
         self.add_sym("exit_R", sym.Ramp(self.svg, False, False, cap_color='green'))
         self.add_sym("entrance_R", sym.Ramp(self.svg, False, True, cap_color='red'))
@@ -43,81 +217,107 @@ class Diagram:
         self.add_sym("lane_join_R", sym.LaneJoiner(self.svg, flipy=True))
         self.add_sym("lane_join_L", sym.LaneJoiner(self.svg, True, True))
 
+        buf = io.StringIO()
+        for el in self.elements:
+            Diagram.write_element(buf, el, 2)
+        self.text = buf.getvalue()
+
     def add_sym(self, id, sym):
         new_sym = self.svg.symbol(id=id)
         new_sym.add(sym.get_sym())
-        self.svg.defs.add(new_sym)
+        self.elements.append(new_sym)
 
-    def add_hwy(self):
-        hwy = Highway(self)
-        self.cur_horiz += self.hwy_offset
-        self.hwys.append(hwy)
-        return hwy
+# Set up in each row rendering process by the pool initializer
+# With fork, the diagram is shared with the parent rather than copied over
+emitter_dwg = None
 
-    def render(self, fmt = 'svg'):
-        self.max_height = 0
-        for hwy in self.hwys:
-            self.max_height = max(self.max_height, len(hwy.rows))
-            # Determine direction
-            exit_nums = []
-            for r in hwy.rows:
-                try:
-                    exit_nums.append(int(r.links[0].number))
-                except (KeyError, IndexError, TypeError, ValueError):
-                    pass
-
-            total_diff = 0
-            for i in range(len(exit_nums)-1):
-                total_diff += exit_nums[i] - exit_nums[i+1]
-
-            if(total_diff < 0):
-                hwy.rows.reverse()
-                hwy.flipped = True
-
-            hwy.render(fmt)
-            if(fmt == 'text'):
-                print('='*(self.hwy_offset+self.text_buffer))
-
-    def save(self, filename):
-        self.svg['width'] = self.cur_horiz*self.gs
-        self.svg['height'] = self.max_height*self.gs
-        return self.svg.saveas(filename, pretty=True)
+def init_emitter(dwg):
+    global emitter_dwg
+    emitter_dwg = dwg
+
+def emit_chunk(chunk):
+    return emitter_dwg.render_chunk(*chunk)
 
 class Highway:
     def __init__(self, diagram):
         self.dwg = diagram
+        self.idx = len(diagram.hwys)
         self.horiz = diagram.cur_horiz
-        self.rows = []
+        self.layout = None
         self.flipped = False
 
-    def add_row(self, offset = None):
-        row = Row(self.dwg, self)
-        if(offset is not None):
-            row.offset = offset
-        self.rows.append(row)
+    def __len__(self):
+        return len(self.layout)
+
+    # Rows are built from the layout as they're rendered, so only the ones
+    # being drawn are ever in memory
+    def row(self, idx):
+        layout = self.layout
+        row = Row(self.dwg, self, layout.lanes[idx], layout.offsets[idx], layout.lane_diffs[idx])
+        for (link_idx, link) in enumerate(layout.links[idx]):
+            ramp = Exit if link.type == 'exit' else Entrance
+            row.add_link(ramp(link.side, link.number), link_idx in layout.caps[idx])
+            row.add_link(Label(link.side, link.type, link.desc))
+
         return row
 
-    def render(self, fmt = 'svg'):
-        for idx in range(len(self.rows)):
-            r = self.rows[idx]
-            try:
-                r.adjust_offset(self.rows[idx+1])
-            except IndexError:
-                pass
-
-            row = r.render(fmt, idx)
-            if(fmt == 'text'):
-                print(row)
-            else:
-                self.dwg.svg.add(row)
+    # Each row's text is passed to emit as soon as it's done
+    def render(self, emit):
+        for idx in range(len(self)):
+            emit(self.row(idx).render('text', idx))
+
+    # Nothing but lanes
+    def is_plain(self, idx):
+        return not (self.layout.links[idx] or self.layout.lane_diffs[idx])
+
+    # In SVGs, runs of identical plain rows are drawn as one element
+    # Yields (first, end) row ranges for each element from first to end,
+    # which should be on group boundaries
+    def iter_groups(self, first = 0, end = None):
+        if end is None:
+            end = len(self)
+        lanes = self.layout.lanes
+        offsets = self.layout.offsets
+
+        group_first = first
+        for idx in range(first + 1, end + 1):
+            if(idx < end and self.is_plain(group_first) and self.is_plain(idx)
+                    and lanes[idx] == lanes[group_first] and offsets[idx] == offsets[group_first]):
+                continue
+            yield (group_first, idx)
+            group_first = idx
+
+    # Ids only depend on where things are in the diagram,
+    # so rendering the same data twice gives the same document
+    def row_id(self, idx):
+        return 'h{}_r{}'.format(self.idx, idx)
+
+    def render_group(self, first_idx, end):
+        if(end - first_idx == 1):
+            return self.row(first_idx).render('svg', first_idx)
+
+        svg = self.dwg.svg
+        num_lanes = self.layout.lanes[first_idx]
+        g = svg.g(id=self.row_id(first_idx))
+
+        edge = Lane.line_width/2
+        rect = svg.rect(
+            insert=(-edge, 0), size=(num_lanes + 2*edge, end - first_idx),
+            fill='url(#{})'.format(self.dwg.lane_pattern(num_lanes))
+        )
+        rect.scale(self.dwg.gs)
+        rect.translate(self.horiz + self.layout.offsets[first_idx], first_idx)
+        g.add(rect)
+
+        return g
 
 class Row:
-    def __init__(self, dwg, hwy):
-        self.lanes = []
+    def __init__(self, dwg, hwy, num_lanes, offset = 0, lane_diff = 0):
+        self.num_lanes = num_lanes
         self.links = []
         self.caps = []
-        self.lane_diff = 0
-        self.offset = 0
+        self.lane_diff = lane_diff
+        self.offset = offset
         self.dwg = dwg
         self.svg = dwg.svg
         self.gs = dwg.gs
@@ -126,42 +326,6 @@ class Row:
     def get_flip(self):
         return 1 if self.hwy.flipped else -1
 
-    def adjust_offset(self, next_row):
-        if(next_row):
-            # Is there a difference in lanes between this lane and next?
-            lane_diff = len(next_row.lanes) - len(self.lanes)
-            lane_adj = 0
-
-            # Check if we already have something that adds a lane
-            # (Entrances, or Exits for flipped highways)
-            for (idx, l) in enumerate(self.links):
-                if(isinstance(l, Exit if self.hwy.flipped else Entrance)):
-                    # If we have one and need a lane added, use it
-                    if(lane_diff > 0):
-                        self.caps.append(idx)
-                        lane_diff-=1
-                        # If it's a left-side lane, it'll eat up one col of offset
-                        if(l.side != self.get_flip()):
-                            lane_adj -= 1
-            # ...and, in the next lane, for something that removes a lane
-            for (idx, l) in enumerate(next_row.links):
-                if(isinstance(l, Entrance if self.hwy.flipped else Exit)):
-                    if(lane_diff < 0):
-                        next_row.caps.append(idx)
-                        lane_diff+=1
-                        # Left-side removers will leave empty below them, adding a col of offset
-                        if(l.side != self.get_flip()):
-                            lane_adj += 1
-
-            # If we still have a difference, note it so we can add a joiner
-            if(lane_diff):
-                rel_row = next_row if lane_diff < 0 else self
-                rel_row.lane_diff = lane_diff
-
-            # TODO: This will always eliminate rightmost lanes
-            # Sometimes we might know that it's the left lane instead?
-            next_row.offset = self.offset + lane_adj
-
     def render(self, fmt, idx):
         self.idx = idx
         pos = (self.offset, self.idx)
@@ -179,15 +343,18 @@ class Row:
             text_bits['left_links'] = [l.render('text', None) for l in self.links if l.side == -1 and not isinstance(l, Label)]
             text_bits['left_extras'] = [e.render('text', None) for e in self.extras if e.side == -1]
         else:
-            g = self.svg.g(id='row' + str(self.idx))
+            g = self.svg.g(id=self.hwy.row_id(self.idx))
 
         text_bits['lanes'] = ''
-        for (i, l) in enumerate(self.lanes):
-            lane = l.render(fmt, i)
+        # Lanes only differ by position, one Lane draws them all
+        lane = Lane()
+        lane.set_row(self)
+        for i in range(self.num_lanes):
+            drawn = lane.render(fmt, i)
             if(fmt == 'svg'):
-                g.add(lane)
+                g.add(drawn)
             else:
-                text_bits['lanes'] += lane
+                text_bits['lanes'] += drawn
 
         if(fmt == 'text'):
             text_bits['right_links'] = [l.render('text', None) for l in self.links if l.side == 1 and not isinstance(l, Label)]
@@ -218,12 +385,10 @@ class Row:
             return row
 
 
-    def add_lane(self, el):
-        el.set_row(self)
-        self.lanes.append(el)
-
-    def add_link(self, el):
+    def add_link(self, el, is_cap = False):
         el.set_row(self)
+        if(is_cap):
+            self.caps.append(len(self.links))
         self.links.append(el)
 
 class Element:
@@ -241,23 +406,27 @@ class Element:
     def get_relpos(self):
         return (self.row.hwy.horiz + self.row.offset, self.row.idx)
 
-    def get_symbol(self, id, relpos, pos, prefixes = []):
+    def get_symbol(self, id, relpos, pos):
         sym = self.svg.use('#' + id, (relpos[0]+pos, relpos[1]))
         sym.scale(self.row.gs)
-        prefixes.append(id)
-        prefixes.append(sym.get_id())
-        sym.attribs['id'] = '_'.join(prefixes)
+        sym.attribs['id'] = '{}_{}_{}'.format(self.row.hwy.row_id(self.row.idx), id, pos)
         return sym
 
 class Lane(Element):
     edge_name = {-1: 'L', 0: 'mid', 1: 'R'}
+    # Matches the lane lines in symbols.Lane
+    line_width = 0.05
     def __init__(self, type = None):
         self.type = type
 
     def edge(self, pos):
+        return self.edge_at(pos, self.row.num_lanes)
+
+    @staticmethod
+    def edge_at(pos, num_lanes):
         if(pos == 0):
             return -1 # Leftmost
-        elif(pos == len(self.row.lanes) - 1):
+        elif(pos == num_lanes - 1):
             return 1 # Rightmost
         else:
             return 0
@@ -283,7 +452,7 @@ class Link(Element):
         self.side = side
 
     def get_pos(self, idx):
-        return -(idx+1) if self.side == -1 else len(self.row.lanes) + idx
+        return -(idx+1) if self.side == -1 else self.row.num_lanes + idx
 
 class Ramp(Link):
     def __init__(self, type = None, number = None):
@@ -298,7 +467,7 @@ class Ramp(Link):
             else:
                 return self.ramp_chars[self.get_flip()][self.side]
 
-        pos = -(idx+1) if self.get_flipside() == -1 else len(self.row.lanes) + idx
+        pos = -(idx+1) if self.get_flipside() == -1 else self.row.num_lanes + idx
 
         nameparts = [self.typestr]
         if(is_cap):
@@ -340,7 +509,7 @@ class Label(Element):
             return ('->' if self.type=='exit' else '<-') + self.abbreviate(self.text)
 
         anchor = 'end' if(self.side != self.get_flip()) else 'start'
-        pos = -(idx+1) if self.side != self.get_flip() else len(self.row.lanes) + idx
+        pos = -(idx+1) if self.side != self.get_flip() else self.row.num_lanes + idx
         our_pos = (pos+1) if(self.side != self.get_flip()) else pos
 
         #TODO: Figure out a baseline to center this vertically as well
@@ -0,0 +1,134 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+# Long-running diagram server
+# Keeps the network in memory and serves rendered diagrams from an LRU
+# cache, reloading everything if any of the source files change
+#
+# GET /svg/<ref>, /text/<ref> or /json/<ref>, e.g. /svg/I%205
+
+log = logging.getLogger('server')
+
+class RenderCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, val):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+
+        self.entries[key] = val
+        self.size += len(val)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            (_, old) = self.entries.popitem(last=False)
+            self.size -= len(old)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+class RequestHandler(BaseHTTPRequestHandler):
+    content_types = {
+        'svg': 'image/svg+xml',
+        'text': 'text/plain; charset=utf-8',
+        'json': 'application/json',
+    }
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/', 1)
+        if len(parts) != 2 or parts[0] not in self.content_types:
+            self.send_error(404, "Expected /svg/<ref>, /text/<ref> or /json/<ref>")
+            return
+
+        (fmt, ref) = (parts[0], unquote(parts[1]))
+        try:
+            body = self.server.get(fmt, ref)
+        except Exception:
+            log.exception("Failed to render %s as %s", ref, fmt)
+            self.send_error(500, "Failed to render {}".format(ref))
+            return
+
+        if body is None:
+            self.send_error(404, "No highway {}".format(ref))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.content_types[fmt])
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.info("%s %s", self.address_string(), format % args)
+
+class DiagramServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # load_network() builds (or loads) the network
+    # render(net, ref, fmt) returns the rendered diagram as a string
+    def __init__(self, address, load_network, render, source_files, cache_bytes):
+        super().__init__(address, RequestHandler)
+        self.load_network = load_network
+        self.render = render
+        self.source_files = source_files
+        self.renders = RenderCache(cache_bytes)
+        # Keeps renders from racing a reload of the network
+        self.lock = threading.Lock()
+
+        self.load()
+
+    def source_state(self):
+        state = []
+        for path in self.source_files:
+            try:
+                st = os.stat(path)
+                state.append((path, st.st_size, st.st_mtime_ns))
+            except OSError:
+                state.append((path, None, None))
+
+        return state
+
+    def load(self):
+        self.state = self.source_state()
+        self.net = self.load_network()
+        self.renders.clear()
+
+    # Returns None if there's no such highway
+    def get(self, fmt, ref):
+        with self.lock:
+            if self.source_state() != self.state:
+                log.info("Source files changed, reloading...")
+                self.load()
+
+            if ref not in self.net.hwys.hwys:
+                return None
+
+            body = self.renders.get((fmt, ref))
+            if body is None:
+                body = self.render(self.net, ref, fmt).encode()
+                self.renders.put((fmt, ref), body)
+
+            return body
+
+def serve(host, port, load_network, render, source_files, cache_bytes):
+    httpd = DiagramServer((host, port), load_network, render, source_files, cache_bytes)
+    log.info("Serving diagrams on http://%s:%s/", host, port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+import argparse
+import random
+import struct
+import zlib
+from xml.sax.saxutils import quoteattr
+
+# Synthetic motorway networks, for benchmarking and trying things out
+# without a real extract
+# Writes the same shape of XML that extract.sh (motorways, links and
+# junction nodes) and entrance_nodes.sh (the streets entrances come from)
+# produce, or the same data as .osm.pbf. The output only depends on the
+# parameters, seed included, so the same network can be regenerated anywhere.
+
+# Distance between nodes along the highway, in degrees
+node_step = 0.001
+# Distance between neighbouring highways
+hwy_step = 0.1
+# Highways run north from start_lat, and nodes are packed closer together
+# on long ones so they never run further than this
+start_lat = 47.0
+max_span = 40.0
+
+# Just enough protobuf encoding to write PBF files pbf.py can read
+def varint(val):
+    # Negative int64s are 10-byte two's complement varints
+    if val < 0:
+        val += 1 << 64
+    out = bytearray()
+    while True:
+        b = val & 0x7f
+        val >>= 7
+        if not val:
+            out.append(b)
+            return bytes(out)
+        out.append(b | 0x80)
+
+def zigzag(val):
+    return (val << 1) ^ (val >> 63)
+
+def pb_int(field, val):
+    return varint(field << 3) + varint(val)
+
+def pb_bytes(field, data):
+    return varint((field << 3) | 2) + varint(len(data)) + data
+
+def pb_packed(field, vals):
+    return pb_bytes(field, b''.join(varint(v) for v in vals))
+
+def deltas(vals):
+    return [zigzag(v - prev) for (v, prev) in zip(vals, [0] + vals[:-1])]
+
+class Generator:
+    # Relative odds of each kind of segment
+    kinds = {
+        'plain': 4,
+        'exit': 5,
+        'entrance': 5,
+        # Lanes are added or dropped
+        'lanes': 4,
+        # Some lanes split off into a parallel way of the same highway,
+        # which joins back up at the end of the segment
+        'split': 2,
+    }
+    nodes_per_seg = 10
+
+    def __init__(self, segments = 100, highways = 1, min_lanes = 2, max_lanes = 5, seed = 1):
+        self.segments = segments
+        self.highways = highways
+        self.min_lanes = min_lanes
+        self.max_lanes = max_lanes
+        self.random = random.Random(seed)
+        self.node_step = min(node_step, max_span/(segments*self.nodes_per_seg))
+
+        self.next_id = 1
+        # (id, lat, lon, tags) and (id, refs, tags)
+        self.nodes = []
+        self.ways = []
+        self.aux_nodes = []
+        self.aux_ways = []
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def node(self, lat, lon, tags = None, aux = False):
+        id = self.new_id()
+        (self.aux_nodes if aux else self.nodes).append((id, lat, lon, tags))
+        return id
+
+    def way(self, refs, tags, aux = False):
+        id = self.new_id()
+        (self.aux_ways if aux else self.ways).append((id, refs, tags))
+        return id
+
+    def generate(self):
+        for h in range(self.highways):
+            self.highway('I {}'.format(5 + 10*h), -122.0 + h*hwy_step)
+        return self
+
+    # One northbound highway along lon, made of self.segments ways
+    def highway(self, ref, lon):
+        kinds = list(self.kinds)
+        weights = [self.kinds[k] for k in kinds]
+        lanes = self.random.randint(self.min_lanes, self.max_lanes)
+        # Hwy.compile keeps drawing split lanes for the rest of the route,
+        # so lanes that split off come out of the highway's own count
+        split_lanes = 0
+        exit_num = 1
+        step = self.node_step
+
+        lat = start_lat
+        start = self.node(lat, lon)
+        for i in range(self.segments):
+            kind = self.random.choices(kinds, weights)[0]
+            side = self.random.choice([1, -1])
+            lats = [lat + k*step for k in range(1, self.nodes_per_seg)]
+            lat += self.nodes_per_seg*step
+            junction = self.nodes_per_seg//2 - 1
+
+            if(kind == 'lanes'):
+                lanes = min(self.max_lanes - split_lanes, max(self.min_lanes, lanes + self.random.choice([1, -1])))
+            elif(kind == 'split' and (lanes < 3 or lanes <= self.min_lanes)):
+                kind = 'plain'
+
+            mids = []
+            for (k, mid_lat) in enumerate(lats):
+                tags = None
+                if(kind == 'exit' and k == junction):
+                    tags = {'highway': 'motorway_junction', 'ref': str(exit_num)}
+                    if self.random.random() < 0.5:
+                        tags['exit_to'] = 'Exit {} Road'.format(exit_num)
+                mids.append(self.node(mid_lat, lon, tags))
+            end = self.node(lat, lon)
+
+            if(kind == 'split'):
+                # Fewer lanes than the trunk, so it stays the trunk
+                branch_lanes = self.random.randint(1, min((lanes - 1)//2, lanes - self.min_lanes))
+                lanes -= branch_lanes
+                split_lanes += branch_lanes
+                branch = [self.node(mid_lat, lon + side*2*step) for mid_lat in lats]
+                tags = {'highway': 'motorway', 'oneway': 'yes', 'ref': ref, 'lanes': str(branch_lanes)}
+                self.way([start] + branch + [end], tags)
+
+            tags = {'highway': 'motorway', 'oneway': 'yes', 'ref': ref, 'lanes': str(lanes)}
+            self.way([start] + mids + [end], tags)
+
+            if(kind == 'exit'):
+                j = mids[junction]
+                j_lat = lats[junction]
+                link = [j,
+                    self.node(j_lat + step, lon + side*step),
+                    self.node(j_lat + 2*step, lon + side*3*step),
+                ]
+                link_tags = {'highway': 'motorway_link', 'oneway': 'yes'}
+                if self.random.random() < 0.5:
+                    link_tags['destination'] = 'Exit {} Street'.format(exit_num)
+                self.way(link, link_tags)
+                exit_num += 1
+            elif(kind == 'entrance'):
+                j = mids[junction]
+                j_lat = lats[junction]
+                link = [
+                    self.node(j_lat - 2*step, lon + side*3*step),
+                    self.node(j_lat - step, lon + side*step),
+                    j,
+                ]
+                self.way(link, {'highway': 'motorway_link', 'oneway': 'yes'})
+
+                # The street the entrance comes from
+                street = self.node(j_lat - 3*step, lon + side*5*step, aux=True)
+                self.way([street, link[0]], {'highway': 'primary', 'name': '{}th Street'.format(i)}, aux=True)
+                # Some are fed by a cross street too, so they have more
+                # than one source to label
+                if(i % 3 == 0):
+                    avenue = self.node(j_lat - 4*step, lon + side*4*step, aux=True)
+                    self.way([avenue, link[0]], {'highway': 'secondary', 'name': '{}th Avenue'.format(i)}, aux=True)
+
+            start = end
+
+    @staticmethod
+    def write_tags(f, tags):
+        for (k, v) in tags.items():
+            f.write('    <tag k={} v={}/>\n'.format(quoteattr(k), quoteattr(v)))
+
+    def write(self, f, aux = False):
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="synth.py">\n')
+        for (id, lat, lon, tags) in (self.aux_nodes if aux else self.nodes):
+            if tags:
+                f.write('  <node id="{}" lat="{:.7f}" lon="{:.7f}">\n'.format(id, lat, lon))
+                self.write_tags(f, tags)
+                f.write('  </node>\n')
+            else:
+                f.write('  <node id="{}" lat="{:.7f}" lon="{:.7f}"/>\n'.format(id, lat, lon))
+
+        for (id, refs, tags) in (self.aux_ways if aux else self.ways):
+            f.write('  <way id="{}">\n'.format(id))
+            for ref in refs:
+                f.write('    <nd ref="{}"/>\n'.format(ref))
+            self.write_tags(f, tags)
+            f.write('  </way>\n')
+        f.write('</osm>\n')
+
+    @staticmethod
+    def write_blob(f, blob_type, data):
+        blob = pb_int(2, len(data)) + pb_bytes(3, zlib.compress(data))
+        header = pb_bytes(1, blob_type.encode()) + pb_int(3, len(blob))
+        f.write(struct.pack('>I', len(header)) + header + blob)
+
+    # strings maps each string to its index in the block's string table
+    def write_block(self, f, strings, group):
+        table = b''.join(pb_bytes(1, s.encode()) for s in strings)
+        self.write_blob(f, 'OSMData', pb_bytes(1, table) + pb_bytes(2, group))
+
+    # Nodes as DenseNodes, then ways, block_size of each per block
+    def write_pbf(self, f, aux = False, block_size = 8000):
+        self.write_blob(f, 'OSMHeader', pb_bytes(4, b'OsmSchema-V0.6') + pb_bytes(4, b'DenseNodes'))
+
+        nodes = self.aux_nodes if aux else self.nodes
+        for c in range(0, len(nodes), block_size):
+            chunk = nodes[c:c+block_size]
+            strings = {'': 0}
+            keys_vals = []
+            for (id, lat, lon, tags) in chunk:
+                for (k, v) in (tags or {}).items():
+                    keys_vals += [strings.setdefault(k, len(strings)), strings.setdefault(v, len(strings))]
+                keys_vals.append(0)
+
+            dense = (
+                pb_packed(1, deltas([n[0] for n in chunk])) +
+                pb_packed(8, deltas([round(n[1]*10000000) for n in chunk])) +
+                pb_packed(9, deltas([round(n[2]*10000000) for n in chunk])) +
+                pb_packed(10, keys_vals)
+            )
+            self.write_block(f, strings, pb_bytes(2, dense))
+
+        ways = self.aux_ways if aux else self.ways
+        for c in range(0, len(ways), block_size):
+            strings = {'': 0}
+            group = b''
+            for (id, refs, tags) in ways[c:c+block_size]:
+                keys = [strings.setdefault(k, len(strings)) for k in tags]
+                vals = [strings.setdefault(v, len(strings)) for v in tags.values()]
+                group += pb_bytes(3, pb_int(1, id) + pb_packed(2, keys) + pb_packed(3, vals) + pb_packed(8, deltas(refs)))
+            self.write_block(f, strings, group)
+
+    # Files ending in .pbf are written as PBF, anything else as XML
+    def save(self, osm_file, aux_file = None):
+        for (filename, aux) in ((osm_file, False), (aux_file, True)):
+            if not filename:
+                continue
+            if str(filename).endswith('.pbf'):
+                with open(filename, 'wb') as f:
+                    self.write_pbf(f, aux)
+            else:
+                with open(filename, 'w', encoding='utf-8') as f:
+                    self.write(f, aux)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Generate a synthetic motorway network")
+    parser.add_argument('--segments', type=int, default=100, help="Motorway ways per highway")
+    parser.add_argument('--highways', type=int, default=1, help="Number of highways (I 5, I 15, ...)")
+    parser.add_argument('--min-lanes', type=int, default=2)
+    parser.add_argument('--max-lanes', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--osm-file', default='motorway.osm', help="Where to write the motorway network (.osm or .osm.pbf)")
+    parser.add_argument('--aux-file', default='link_nodes_1.osm', help="Where to write the streets entrances come from")
+    args = parser.parse_args()
+
+    gen = Generator(args.segments, args.highways, args.min_lanes, args.max_lanes, args.seed)
+    gen.generate().save(args.osm_file, args.aux_file)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,18 @@
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+import xml.etree.ElementTree as ET
+
+from hwy import Network, np
+import cache
+import exits
+import layout
+import synth
 
 # TODO: Get these into tests
 #print(links[452336723].get_ang(True))
@@ -16,5 +30,390 @@ import unittest
 ## Breaks, not correct seg
 #print(hwy_segs[5130429].get_side(links[85106512]))
 
+# Networks come from synth.py, so they're the same every run
+def synth_files(tmp, segments = 16, highways = 1, seed = 3, ext = '.osm'):
+    osm_file = os.path.join(tmp, 'motorway' + ext)
+    aux_file = os.path.join(tmp, 'aux' + ext)
+    synth.Generator(segments, highways, seed=seed).generate().save(osm_file, aux_file)
+    return (osm_file, aux_file)
+
+def build_network(tmp, segments = 16, highways = 1, seed = 3, ext = '.osm', **kwargs):
+    (osm_file, aux_file) = synth_files(tmp, segments, highways, seed, ext)
+
+    if ext == '.osm':
+        net = Network(osm_file, **kwargs)
+        net.parse_aux_ways(aux_file)
+    else:
+        net = Network(osm_file, jobs=1, **kwargs)
+        net.extract_aux_ways(aux_file, jobs=1)
+    return net
+
+class NetworkTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def build(self, **kwargs):
+        return build_network(self.tmp.name, **kwargs)
+
+class LayoutTest(NetworkTest):
+    def test_text(self):
+        text = exits.render_string(self.build(), 'I 5', 'text')
+        self.assertEqual(text.splitlines(), [
+            '    ⤣┨┆┆┆┆┠->5: ???',
+            '     ┨┆┆┆┆┠',
+            '     ┨┆┆┆┠\\',
+            '     ⇗┨┆┆┠<-10th',
+            '      ┨┆┆┠⤤->4: Exit 4 Street',
+            '      ┨┆┆┠⇖<-7th',
+            '      ┨┆┆┠⤤->3: Exit 3 Street',
+            '     ⇗┨┆┆┠<-4th',
+            '      ┨┆┆┠⤤->2: Exit 2 Road',
+            '     ⤣┨┆┆┠->1: Exit 1 Street',
+            '      ┨┆┆┠⇖<-0th Street/0th Avenue',
+            '==========================================',
+        ])
+
+    def test_json(self):
+        (layout,) = json.loads(exits.render_string(self.build(), 'I 5', 'json'))['highways']
+        self.assertTrue(layout['flipped'])
+        self.assertEqual(layout['lanes'], [5, 5, 4, 3, 3, 3, 3, 3, 3, 3, 3])
+        self.assertEqual(layout['offsets'], [0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1])
+        self.assertEqual(layout['lane_diffs'], [0, 0, -1, 0, 0, 0, 0, 0, 0, 0, 0])
+        self.assertEqual(layout['caps'], [[], [], [], [0], [], [], [], [], [], [], []])
+        self.assertEqual([[(l['type'], l['side'], l['number']) for l in links] for links in layout['links']], [
+            [('exit', -1, '5')], [], [],
+            [('entrance', -1, None)], [('exit', 1, '4')],
+            [('entrance', 1, None)], [('exit', 1, '3')],
+            [('entrance', -1, None)], [('exit', 1, '2')],
+            [('exit', -1, '1')], [('entrance', 1, None)],
+        ])
+
+    # Split-off lanes are drawn as part of the trunk, and the branch itself
+    # isn't followed
+    def test_split(self):
+        net = self.build()
+        hwy = net.hwys.get_hwy('I 5')
+        self.assertEqual(len(hwy.starts), 1)
+        steps = hwy.get_plan()[0]
+        self.assertEqual(len(steps), 16)
+        self.assertEqual(len(net.hwy_segs.segs), 17)
+
+        (idx,) = [i for (i, step) in enumerate(steps) if hwy.branches(step.seg.start, 'start')[1]]
+        (_, (branch,)) = hwy.branches(steps[idx].seg.start, 'start')
+        self.assertEqual(steps[idx].lanes, steps[idx].seg.lanes + branch.lanes)
+        self.assertEqual(steps[idx].lanes, steps[idx-1].lanes)
+
+class PbfTest(NetworkTest):
+    def test_parity(self):
+        xml_net = self.build(segments=40, highways=2)
+        pbf_net = self.build(segments=40, highways=2, ext='.osm.pbf')
+
+        self.assertEqual(sorted(xml_net.hwy_segs.segs), sorted(pbf_net.hwy_segs.segs))
+        self.assertEqual(sorted(xml_net.link_segs.segs), sorted(pbf_net.link_segs.segs))
+        for name in ('I 5', 'I 15'):
+            for fmt in ('text', 'json'):
+                self.assertEqual(
+                    exits.render_string(xml_net, name, fmt),
+                    exits.render_string(pbf_net, name, fmt),
+                )
+
+class SideTest(NetworkTest):
+    # Generated highways run north, so links off to the east are on the right
+    def test_get_side(self):
+        net = self.build(segments=40)
+        sides = set()
+        for seg in net.hwy_segs.segs.values():
+            for (link_type, link) in seg.links:
+                ramp = link.nodes[1] if link_type == 'exit' else link.nodes[-2]
+                junction = link.start if link_type == 'exit' else link.end
+                expected = 1 if net.nodes[ramp].lon > net.nodes[junction].lon else -1
+                self.assertEqual(seg.get_side(link), expected, "{} {}".format(link_type, link.id))
+                sides.add((link_type, expected))
+
+        self.assertEqual(sides, {('exit', 1), ('exit', -1), ('entrance', 1), ('entrance', -1)})
+
+# Byte-for-byte output
+class SvgTest(NetworkTest):
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    # Generated highways have a link or lane change on nearly every row, so
+    # there's a hand-built one with runs of plain rows too
+    def layouts(self):
+        net = self.build(segments=40, highways=2)
+        plain = layout.Layout()
+        for lanes in [3]*50 + [4]*20 + [3]*3:
+            plain.add_row(lanes)
+        plain.add_row(3, (layout.LinkRecord('exit', 1, '5', '5: Foo'),))
+        for lanes in [3]*10:
+            plain.add_row(lanes)
+        plain.orient()
+        plain.place()
+
+        return layout.layout_hwy(net.hwys.get_hwy('I 5')) + layout.layout_hwy(net.hwys.get_hwy('I 15')) + [plain]
+
+    def test_repeatable(self):
+        layouts = self.layouts()
+        svg = exits.build_diagram(layouts).tostring()
+        self.assertIn('<pattern', svg)
+        self.assertEqual(exits.build_diagram(layouts).tostring(), svg)
+        self.assertEqual(exits.build_diagram(self.layouts()).tostring(), svg)
+
+    # Labels with more than one source used to come out in hash order
+    def test_hash_seed(self):
+        (osm_file, aux_file) = synth_files(self.tmp.name, segments=40, highways=2)
+        outputs = set()
+        for seed in ('0', '1', '2', '3'):
+            run = subprocess.run(
+                [sys.executable, os.path.join(self.here, 'exits.py'), '--osm-file', osm_file, '--aux-source', aux_file,
+                    '--highway', 'I 5', '--text', '-', '--svg', '-'],
+                stdout=subprocess.PIPE, env=dict(os.environ, PYTHONHASHSEED=seed), check=True
+            )
+            outputs.add(run.stdout)
+
+        (output,) = outputs
+        self.assertIn('Street/'.encode(), output)
+
+    # Rows rendered across processes are still written out in order
+    def test_jobs(self):
+        layouts = self.layouts()
+        serial = exits.build_diagram(layouts).tostring()
+
+        dwg = exits.build_diagram(layouts)
+        dwg.chunk_size = 4
+        self.assertGreater(len(dwg.chunk_rows()), 3)
+        buf = io.StringIO()
+        dwg.stream(buf, jobs=3)
+        self.assertEqual(buf.getvalue(), serial)
+
+    # Elements, attributes and text, without the formatting
+    def canonical(self, svg):
+        def walk(el):
+            return (el.tag, sorted(el.attrib.items()), (el.text or '').strip(), [walk(child) for child in el])
+        return walk(ET.fromstring(svg.encode('utf-8')))
+
+    # The two only differ in whitespace
+    def test_fast_backend(self):
+        layouts = self.layouts()
+        svg = exits.build_diagram(layouts).tostring()
+        fast = exits.build_diagram(layouts, 'fast').tostring()
+        self.assertEqual(self.canonical(fast), self.canonical(svg))
+
+    def test_svgz(self):
+        dwg = exits.build_diagram(self.layouts())
+        svgz = []
+        for name in ('a.svgz', 'b.svgz'):
+            filename = os.path.join(self.tmp.name, name)
+            dwg.save(filename)
+            with open(filename, 'rb') as f:
+                svgz.append(f.read())
+
+        self.assertEqual(svgz[0], svgz[1])
+        self.assertEqual(gzip.decompress(svgz[0]).decode('utf-8'), dwg.tostring())
+
+# Motorways without a ref joining a highway are treated as links
+class ConnectorTest(unittest.TestCase):
+    osm = '''<osm>
+        <node id="1" lat="47.0" lon="-122.0"/>
+        <node id="2" lat="47.01" lon="-122.0"/>
+        <node id="3" lat="47.02" lon="-122.0"/>
+        <node id="4" lat="47.03" lon="-122.0"/>
+        <node id="10" lat="47.02" lon="-121.99"/>
+        <way id="100">
+            <nd ref="1"/><nd ref="2"/><nd ref="3"/>
+            <tag k="highway" v="motorway"/><tag k="ref" v="I 5"/><tag k="oneway" v="yes"/><tag k="lanes" v="3"/>
+        </way>
+        <way id="101">
+            <nd ref="3"/><nd ref="4"/>
+            <tag k="highway" v="motorway"/><tag k="ref" v="I 5"/><tag k="oneway" v="yes"/><tag k="lanes" v="3"/>
+        </way>
+        <way id="200">
+            <nd ref="2"/><nd ref="10"/>
+            <tag k="highway" v="motorway"/><tag k="oneway" v="yes"/>
+        </way>
+    </osm>'''
+
+    def test_unnamed(self):
+        net = Network(ET.fromstring(self.osm))
+        self.assertEqual([(t, l.id) for (t, l) in net.hwy_segs.get(100).links], [('exit', 200)])
+
+        self.assertEqual(exits.render_string(net, 'I 5', 'text').splitlines(), [
+            '    ⤦┨┆┆┠->???',
+            '==========================================',
+        ])
+        (layout,) = json.loads(exits.render_string(net, 'I 5', 'json'))['highways']
+        self.assertEqual(layout['links'], [[{'type': 'exit', 'side': 1, 'number': None, 'desc': '???'}]])
+        self.assertIn('>???</text>', exits.render_string(net, 'I 5', 'svg'))
+
+@unittest.skipIf(np is None, "Compact nodes require numpy")
+class NodeStoreTest(NetworkTest):
+    def test_parity(self):
+        net = self.build(segments=40, highways=2)
+        compact_net = self.build(segments=40, highways=2, compact_nodes=True)
+        nodes = net.nodes
+        store = compact_net.nodes
+
+        self.assertEqual(len(store), len(nodes))
+        self.assertEqual(sorted(store), sorted(nodes))
+        self.assertNotIn(-1, store)
+        self.assertIsNone(store.get(-1))
+
+        for (id, node) in nodes.items():
+            stored = store[id]
+            self.assertAlmostEqual(stored.lat, node.lat, places=7)
+            self.assertAlmostEqual(stored.lon, node.lon, places=7)
+            self.assertEqual(stored.tags, node.tags)
+            self.assertEqual(stored.name, node.name)
+        # Junction names are what exit numbers come from
+        self.assertTrue(any(n.name for n in nodes.values()))
+
+        ids = sorted(nodes)
+        (lats, lons) = store.coords(ids)
+        self.assertEqual(lats.tolist(), [store[id].lat for id in ids])
+        self.assertEqual(lons.tolist(), [store[id].lon for id in ids])
+
+        for name in ('I 5', 'I 15'):
+            for fmt in ('text', 'json'):
+                self.assertEqual(
+                    exits.render_string(compact_net, name, fmt),
+                    exits.render_string(net, name, fmt),
+                )
+
+class CacheTest(NetworkTest):
+    def check_round_trip(self, **options):
+        (osm_file, aux_file) = synth_files(self.tmp.name, segments=40, highways=2)
+        cache_dir = os.path.join(self.tmp.name, 'cache')
+        builds = []
+
+        def build():
+            builds.append(options)
+            net = Network(osm_file, **options)
+            net.parse_aux_ways(aux_file)
+            return net
+
+        expected = build()
+        built = cache.load_or_build(cache_dir, [osm_file, aux_file], options, build)
+        loaded = cache.load_or_build(cache_dir, [osm_file, aux_file], options, build)
+        # The second one came from the cache
+        self.assertEqual(len(builds), 2)
+        self.assertIsNot(loaded, built)
+
+        self.assertTrue(any(l.aux_links for l in loaded.link_segs.segs.values()))
+        for net in (built, loaded):
+            for name in ('I 5', 'I 15'):
+                for fmt in ('text', 'json', 'svg'):
+                    self.assertEqual(
+                        exits.render_string(net, name, fmt),
+                        exits.render_string(expected, name, fmt),
+                        "{} {}".format(name, fmt)
+                    )
+
+    def test_round_trip(self):
+        self.check_round_trip()
+
+    @unittest.skipIf(np is None, "Compact networks require numpy")
+    def test_compact_round_trip(self):
+        self.check_round_trip(compact_nodes=True, compact_index=True)
+
+    # Motorway links are pickled as ids, like other links
+    def test_connectors(self):
+        path = os.path.join(self.tmp.name, 'connectors.pickle')
+        expected = Network(ET.fromstring(ConnectorTest.osm))
+        cache.save(path, expected)
+        net = cache.load(path)
+
+        self.assertEqual(net.hwy_segs.get(100).links, [('exit', net.hwy_segs.get(200))])
+        for fmt in ('text', 'json', 'svg'):
+            self.assertEqual(exits.render_string(net, 'I 5', fmt), exits.render_string(expected, 'I 5', fmt))
+
+# Chains of links that fork partway along, merge in partway along, and
+# loop back on themselves, off one highway:
+#  - exit 300 forks into 301 partway along, and carries on into 302
+#  - 302 forks into 304 partway along, and loops back into 300 via 303
+#  - entrance 400 has 401 merging into it partway along
+class LinkChainTest(unittest.TestCase):
+    nodes = {
+        1: (47.0, -122.0), 2: (47.01, -122.0), 3: (47.02, -122.0), 4: (47.03, -122.0), 5: (47.04, -122.0),
+        20: (47.012, -121.998), 21: (47.014, -121.996), 22: (47.016, -121.994),
+        30: (47.014, -121.99), 31: (47.014, -121.985),
+        40: (47.018, -121.994), 41: (47.018, -121.998), 42: (47.015, -121.999), 50: (47.02, -121.99),
+        60: (47.015, -122.01), 61: (47.018, -122.005), 70: (47.014, -122.02), 71: (47.016, -122.015),
+    }
+    hwys = {100: [1, 2, 3, 4], 101: [4, 5]}
+    links = {
+        300: [2, 20, 21, 22], 301: [21, 30, 31], 302: [22, 40, 41], 303: [41, 42, 20], 304: [40, 50],
+        400: [60, 61, 3], 401: [70, 71, 61],
+    }
+
+    def setUp(self):
+        osm = ET.Element('osm')
+        for (id, (lat, lon)) in self.nodes.items():
+            ET.SubElement(osm, 'node', id=str(id), lat=str(lat), lon=str(lon))
+        for (ways, tags) in ((self.hwys, {'highway': 'motorway', 'ref': 'I 5', 'lanes': '3'}), (self.links, {'highway': 'motorway_link'})):
+            for (id, refs) in ways.items():
+                way = ET.SubElement(osm, 'way', id=str(id))
+                for ref in refs:
+                    ET.SubElement(way, 'nd', ref=str(ref))
+                for (k, v) in dict(tags, oneway='yes').items():
+                    ET.SubElement(way, 'tag', k=k, v=v)
+        self.net = Network(osm)
+
+    def lasts(self, link_id, towards):
+        return sorted(s.id for s in self.net.link_segs.lookup_last(link_id, towards))
+
+    def test_lookup_last(self):
+        for link_id in (300, 302, 303):
+            self.assertEqual(self.lasts(link_id, 'end'), [301, 304], link_id)
+        self.assertEqual(self.lasts(301, 'end'), [301])
+        self.assertEqual(self.lasts(304, 'end'), [304])
+        # Everything in the loop leads back to where it leaves the highway
+        for link_id in (300, 301, 302, 303, 304):
+            self.assertEqual(self.lasts(link_id, 'start'), [300], link_id)
+
+        self.assertEqual(self.lasts(400, 'start'), [400, 401])
+        self.assertEqual(self.lasts(401, 'start'), [401])
+        self.assertEqual(self.lasts(401, 'end'), [400])
+
+    def test_dump_link_nodes(self):
+        self.assertEqual([(t, l.id) for (t, l) in self.net.hwy_segs.get(100).links], [('exit', 300), ('entrance', 400)])
+        self.assertEqual(self.net.dump_link_nodes('exit'), {31, 50})
+        self.assertEqual(self.net.dump_link_nodes('entrance'), {60, 70})
+        self.assertEqual(self.net.dump_link_nodes('all'), {31, 50, 60, 70})
+
+@unittest.skipIf(np is None, "Frozen indexes require numpy")
+class SegIndexTest(NetworkTest):
+    def lookups(self, idx, node_ids, partitions):
+        return [
+            (
+                sorted(idx.lookup(node_id, key, part)),
+                [s.id for s in idx.lookup_segs(node_id, key, part)],
+                [(t, s.id) for (t, s) in idx.lookup_all([node_id], part)],
+            )
+            for node_id in node_ids
+            for key in ('start', 'end')
+            for part in partitions
+        ]
+
+    def sizes(self, idx):
+        return {key: {part: len(index) for (part, index) in parts.items()} for (key, parts) in idx.indexes.items()}
+
+    def test_frozen(self):
+        net = self.build(segments=40, highways=2)
+        # Plus a node that isn't in any segment
+        node_ids = sorted(set(n for s in net.hwy_segs.segs.values() for n in s.nodes)) + [-1]
+
+        for (idx, partitions) in ((net.hwy_segs, [None, 'I 5', 'I 15', 'I 99']), (net.link_segs, [None])):
+            sizes = self.sizes(idx)
+            expected = self.lookups(idx, node_ids, partitions)
+            # Misses don't add anything
+            self.assertEqual(self.sizes(idx), sizes)
+
+            idx.freeze()
+            self.assertEqual(self.lookups(idx, node_ids, partitions), expected)
+
+        self.assertTrue(any(segs for (segs, _, _) in expected))
+        with self.assertRaises(RuntimeError):
+            net.link_segs.add(next(iter(net.link_segs.segs.values())))
+
 if __name__ == '__main__':
     unittest.main()